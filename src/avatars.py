@@ -0,0 +1,226 @@
+"""
+Avatar fetching.
+
+Avatars are requested from the CDN at the smallest size the template actually
+needs (Discord serves powers of two between 16 and 4096), in a static format,
+downloaded concurrently with a timeout and a few retries, and decoded off the
+event loop. Decoded avatars are kept in a small in-memory LRU so e.g. `/boil`
+followed by `/framemog` of the same person only downloads once.
+
+Animated (a_-prefixed) avatars can be fetched as GIFs instead. Those are kept
+as raw bytes and only the frames a template actually samples get decoded, see
+`AnimatedAvatar`.
+"""
+
+import asyncio
+import bisect
+from collections import OrderedDict
+import io
+import itertools
+import os
+
+import aiohttp
+import discord
+import numpy as np
+from PIL import Image, ImageSequence
+
+
+AVATAR_TIMEOUT = float(os.getenv('AVATAR_TIMEOUT', '10'))
+AVATAR_RETRIES = int(os.getenv('AVATAR_RETRIES', '2'))
+AVATAR_CACHE_SIZE = int(os.getenv('AVATAR_CACHE_SIZE', '64'))
+ANIMATED_AVATARS = os.getenv('ANIMATED_AVATARS', '1') == '1'
+# Most distinct avatar frames a single render will decode and hold on to
+ANIMATED_MAX_FRAMES = int(os.getenv('ANIMATED_MAX_FRAMES', '48'))
+
+MIN_CDN_SIZE = 16
+MAX_CDN_SIZE = 4096
+STATIC_FORMAT = 'png'
+ANIMATED_FORMAT = 'gif'
+
+# (asset key, size, format) -> decoded RGBA image / AnimatedAvatar, most recently used last
+_decoded = OrderedDict()
+# (asset key, size, format) -> future for downloads already in flight
+_in_flight = {}
+
+
+def request_size(max_slot_size):
+    """Smallest CDN size (power of two) at or above the template's largest slot."""
+    size = MIN_CDN_SIZE
+    while size < max_slot_size and size < MAX_CDN_SIZE:
+        size *= 2
+    return size
+
+
+def _frame_duration(frame):
+    # Browsers (and Discord) play 0-10ms GIF frames at 100ms
+    duration = frame.info.get('duration') or 0
+    return duration if duration > 10 else 100
+
+
+class AnimatedAvatar:
+    """
+    An animated avatar that is decoded lazily.
+
+    Only the encoded bytes and the frame timeline are kept. `sample` maps a
+    template's timeline onto the avatar's own timeline and then decodes the
+    avatar once, front to back, keeping just the frames that are actually hit.
+    That bounds the cost by the template's frame count (and
+    ANIMATED_MAX_FRAMES), not by template frames x avatar frames.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        with Image.open(io.BytesIO(data)) as image:
+            self.size = image.size
+            self.durations = [_frame_duration(frame) for frame in ImageSequence.Iterator(image)]
+        self.starts = list(itertools.accumulate(self.durations, initial=0))[:-1]
+        self.total_duration = sum(self.durations)
+
+    @property
+    def frame_count(self):
+        return len(self.durations)
+
+    def iter_frames(self, wanted):
+        """Yield (index, RGBA frame) for the frame indices in `wanted`, decoding front to back."""
+        wanted = set(wanted)
+        last = max(wanted, default=-1)
+        with Image.open(io.BytesIO(self.data)) as image:
+            for index, frame in enumerate(ImageSequence.Iterator(image)):
+                if index > last:
+                    break
+                if index in wanted:
+                    yield index, frame.convert('RGBA')
+
+    def frame_at(self, time_ms):
+        """Index of the avatar frame showing at `time_ms` (looping)."""
+        return bisect.bisect_right(self.starts, time_ms % self.total_duration) - 1
+
+    def sample(self, template_durations, max_frames=ANIMATED_MAX_FRAMES):
+        """
+        Avatar frames to show on each template frame.
+
+        Args:
+            template_durations: Per-frame durations (ms) of the template
+            max_frames: Cap on distinct avatar frames decoded; beyond it the
+                sampled frames are thinned out evenly
+
+        Returns:
+            A list with one RGBA image per template frame (frames are shared, treat them as read-only)
+        """
+        times = itertools.accumulate(template_durations, initial=0)
+        indices = [self.frame_at(t) for t, _ in zip(times, template_durations)]
+
+        needed = sorted(set(indices))
+        if len(needed) > max_frames:
+            kept = sorted({needed[int(i)] for i in np.linspace(0, len(needed) - 1, max_frames)})
+            # Snap every sampled index to the closest kept frame at or before it
+            indices = [kept[max(bisect.bisect_right(kept, index) - 1, 0)] for index in indices]
+            needed = kept
+
+        frames = dict(self.iter_frames(needed))
+        return [frames[index] for index in indices]
+
+
+def as_rgba(image):
+    """Open `image` (a path or an already decoded PIL image) as RGBA."""
+    if isinstance(image, Image.Image):
+        return image.convert('RGBA')
+    return Image.open(image).convert('RGBA')
+
+
+def image_size(image):
+    """(width, height) of a path, or of anything with a size (PIL image, AnimatedAvatar, sprites.SpriteSet)."""
+    if hasattr(image, 'size'):
+        return image.size
+    with Image.open(image) as opened:
+        return opened.size
+
+
+def wants_animated(asset):
+    """Whether this avatar should be fetched (and cached) as an animation."""
+    return ANIMATED_AVATARS and asset.is_animated()
+
+
+def _decode(data):
+    image = Image.open(io.BytesIO(data)).convert('RGBA')
+    image.load()
+    return image
+
+
+def _is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError)):
+        return True
+    return isinstance(error, discord.HTTPException) and (error.status >= 500 or error.status == 429)
+
+
+async def _download(asset, logger=None):
+    for attempt in range(AVATAR_RETRIES + 1):
+        try:
+            return await asyncio.wait_for(asset.read(), timeout=AVATAR_TIMEOUT)
+        except Exception as e:
+            if attempt == AVATAR_RETRIES or not _is_retryable(e):
+                raise
+            if logger is not None:
+                logger.warning(f"Avatar download failed ({e!r}), retrying ({attempt + 1}/{AVATAR_RETRIES})")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+async def _fetch(asset, size, format, logger=None):
+    sized = asset.replace(size=size, format=format)
+    if logger is not None:
+        logger.info(f"Downloading avatar from: {sized.url}")
+    data = await _download(sized, logger)
+    if logger is not None:
+        logger.info(f"Avatar downloaded: {len(data) / 1024:.1f} KB")
+    if format == ANIMATED_FORMAT:
+        return await asyncio.to_thread(AnimatedAvatar, data)
+    return await asyncio.to_thread(_decode, data)
+
+
+async def fetch_avatar(asset, size, logger=None, animated=False):
+    """
+    Fetch and decode a single avatar.
+
+    Args:
+        asset: The user's `display_avatar`
+        size: CDN size to request, see `request_size`
+        logger: Optional logger for download progress
+        animated: Fetch animated avatars as an `AnimatedAvatar` instead of flattening
+            them to their first frame. Ignored for static avatars.
+
+    Returns:
+        The decoded RGBA image (or `AnimatedAvatar`). Treat it as read-only, it's shared through the LRU.
+    """
+    format = ANIMATED_FORMAT if animated and asset.is_animated() else STATIC_FORMAT
+    key = (asset.key, size, format)
+
+    if key in _decoded:
+        _decoded.move_to_end(key)
+        return _decoded[key]
+
+    # Someone else is already downloading this avatar - wait for theirs
+    if key in _in_flight:
+        return await asyncio.shield(_in_flight[key])
+
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[key] = future
+    try:
+        image = await _fetch(asset, size, format, logger)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Nobody may be waiting on it; don't let asyncio complain about it
+        future.exception()
+        raise
+    else:
+        future.set_result(image)
+    finally:
+        del _in_flight[key]
+
+    _decoded[key] = image
+    while len(_decoded) > AVATAR_CACHE_SIZE:
+        _decoded.popitem(last=False)
+    return image
+
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 from pathlib import Path
@@ -7,6 +8,7 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
+from src import files, looplag, templates
 from src.commands.boiler import boiler
 from src.commands.framemog import framemogger
 
@@ -23,10 +25,11 @@ bot = commands.Bot(command_prefix='!', intents=intents)
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 
 # Paths to template GIFs with green square
-COALTHROW_IMAGE = Path("/app/templates/coalthrow.png")
-BOILER_TEMPLATE = Path("/app/templates/boiler_template.gif")
-FRAMEMOG_TEMPLATE = Path("/app/templates/framemog_template.gif")
-PET_TEMPLATE = Path("/app/templates/pet_template.gif")
+TEMPLATE_DIR = Path(os.getenv('TEMPLATE_DIR', '/app/templates'))
+COALTHROW_IMAGE = TEMPLATE_DIR / "coalthrow.png"
+BOILER_TEMPLATE = TEMPLATE_DIR / "boiler_template.gif"
+FRAMEMOG_TEMPLATE = TEMPLATE_DIR / "framemog_template.gif"
+PET_TEMPLATE = TEMPLATE_DIR / "pet_template.gif"
 # BOILBOARD_DB = Path("/app/databases/boilboard.db")
 
 # Coal reaction settings
@@ -42,6 +45,9 @@ async def on_ready():
     logger.info(f'{bot.user} has connected to Discord!')
     logger.info(f'bot is ready to rot brains')
 
+    # Watch for anything blocking the event loop
+    looplag.start()
+
     if has_synced:
         logger.info("Skipping sync - already synced this session")
         return
@@ -70,8 +76,16 @@ async def on_ready():
         logger.error(f"Failed to sync commands: {e}")
         logger.error(traceback.format_exc())
 
+    # Compile the lower resolution template tiers up front (otherwise the first render of each does it)
+    try:
+        await asyncio.to_thread(templates.compile_all, [BOILER_TEMPLATE, FRAMEMOG_TEMPLATE])
+        logger.info("Template tiers compiled")
+    except Exception as e:
+        logger.error(f"Failed to compile template tiers: {e}")
+
 
 @bot.event
+@looplag.handler
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     """Watch for coal emoji reactions and reply when threshold is reached."""
     # Check if the emoji matches the coal emoji
@@ -95,7 +109,7 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
             if str(reaction.emoji.name if hasattr(reaction.emoji, 'name') else reaction.emoji) == COAL_EMOJI:
                 if reaction.count >= COAL_THRESHOLD:
                     coal_replied_messages.add(message.id)
-                    await message.reply(file=discord.File(COALTHROW_IMAGE))
+                    await message.reply(file=await files.discord_file(COALTHROW_IMAGE))
                     logger.info(f"Coal threshold reached on message {message.id} with {reaction.count} reactions")
                 break
     except Exception as e:
@@ -105,8 +119,17 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
 
 @bot.tree.command(name='boil', description='Boil a user\'s profile picture!')
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
-@app_commands.describe(user='The user whose profile picture you want to boil (leave empty for yourself)')
-async def boil(interaction: discord.Interaction, user: discord.User = None):
+@app_commands.describe(
+    user='The user whose profile picture you want to boil (leave empty for yourself)',
+    output_format='Output format (defaults to the server\'s setting)',
+)
+@app_commands.choices(output_format=[
+    app_commands.Choice(name='GIF', value='gif'),
+    app_commands.Choice(name='WebP', value='webp'),
+    app_commands.Choice(name='WebP (lossless)', value='webp-lossless'),
+])
+@app_commands.rename(output_format='format')
+async def boil(interaction: discord.Interaction, user: discord.User = None, output_format: str = None):
     """
     Slash command to boil a user's profile picture.
     Usage: /boil @user or /boil (to boil your own avatar)
@@ -116,14 +139,24 @@ async def boil(interaction: discord.Interaction, user: discord.User = None):
     # Defer the response since this might take a moment
     await interaction.response.defer() # type: ignore
 
-    await boiler(interaction, user, BOILER_TEMPLATE, logger)
+    await boiler(interaction, user, BOILER_TEMPLATE, logger, output_format)
     # await boiler(interaction, user, BOILER_TEMPLATE, BOILBOARD_DB, logger)
 
 
 @bot.tree.command(name='framemog', description='Framemog a user')
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
-@app_commands.describe(user='The user you framemog', location='The location of the framemog')
-async def framemog(interaction: discord.Interaction, user: discord.User, location: str = None):
+@app_commands.describe(
+    user='The user you framemog',
+    location='The location of the framemog',
+    output_format='Output format (defaults to the server\'s setting)',
+)
+@app_commands.choices(output_format=[
+    app_commands.Choice(name='GIF', value='gif'),
+    app_commands.Choice(name='WebP', value='webp'),
+    app_commands.Choice(name='WebP (lossless)', value='webp-lossless'),
+])
+@app_commands.rename(output_format='format')
+async def framemog(interaction: discord.Interaction, user: discord.User, location: str = None, output_format: str = None):
     """
     Slash command to framemog someone.
     Usage: /framemog @user
@@ -133,13 +166,14 @@ async def framemog(interaction: discord.Interaction, user: discord.User, locatio
     # Defer the response since this might take a moment
     await interaction.response.defer() # type: ignore
 
-    await framemogger(interaction, user, location, FRAMEMOG_TEMPLATE, logger)
+    await framemogger(interaction, user, location, FRAMEMOG_TEMPLATE, logger, output_format)
     # await framemogger(interaction, user, FRAMEMOG_TEMPLATE, _DB, logger)
 
 
 @bot.tree.command(name='pet', description='Pet a user\'s profile picture!')
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
 @app_commands.describe() #user='The user whose profile picture you want to boil (leave empty to pet the bot)')
+@looplag.handler
 async def pet(interaction: discord.Interaction):
     """
     Slash command to pet boiler bot.
@@ -157,7 +191,7 @@ async def pet(interaction: discord.Interaction):
         # Send the result
         await interaction.followup.send(
             content=f'"thanks for petting me 🥰" -boiler bot',
-            file=discord.File(PET_TEMPLATE)
+            file=await files.discord_file(PET_TEMPLATE)
         )
 
     except Exception as e:
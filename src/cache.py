@@ -0,0 +1,281 @@
+"""
+Shared render cache helpers.
+
+The ./cache directory is a volume that can be mounted into several bot or
+render replicas at once, so nothing in here may assume it is the only writer:
+
+- entries are published with a temp file + rename, so readers either see the
+  previous file or the complete new one, never a half-written GIF
+- a `<entry>.lock` file marks a key that some replica is rendering right now,
+  so the other replicas wait for it instead of rendering the same thing
+- locks left behind by a crashed replica are detected as stale and broken
+"""
+
+import asyncio
+import contextlib
+import glob
+import os
+import shutil
+import socket
+import time
+import uuid
+
+from src import formats, templates
+
+
+LOCK_SUFFIX = '.lock'
+
+# A lock whose file hasn't been touched for this long is considered abandoned.
+# Holders refresh their lock every LOCK_STALE_AFTER / 4 seconds while rendering.
+LOCK_STALE_AFTER = float(os.getenv('CACHE_LOCK_STALE_AFTER', '120'))
+LOCK_POLL_INTERVAL = 0.25
+
+HOSTNAME = socket.gethostname()
+
+
+def entry_path(kind, key, tier=100, output_format=formats.FORMATS['gif'], level=0):
+    """
+    Cache file of a render: cache/<kind>/<key>[_t<tier>][_q<level>][<format suffix>].<ext>
+
+    The full tier has no tier suffix, full quality (level 0, see quality.LADDER)
+    no quality suffix, and only formats that share an extension with another
+    one (lossless WebP) have a format suffix.
+    """
+    suffix = '' if tier == 100 else f'_t{tier}'
+    if level:
+        suffix += f'_q{level}'
+    return f'cache/{kind}/{key}{suffix}{output_format.cache_suffix}.{output_format.ext}'
+
+
+def open_cached(cache_file):
+    """
+    Open a cache entry for reading.
+
+    Opening (instead of checking os.path.exists and then opening later) keeps the
+    entry readable even if another replica prunes it while we're still uploading.
+
+    Returns:
+        A binary file object, or None if the entry doesn't exist.
+    """
+    try:
+        return open(cache_file, 'rb')
+    except FileNotFoundError:
+        return None
+
+
+def open_best_cached(kind, key, limit, output_format=formats.FORMATS['gif'], levels=(0,)):
+    """
+    Open the best cached render of `key` in `output_format` that is at most `limit` bytes.
+
+    Quality levels are tried in the given order, and the highest tier first within each.
+
+    Returns:
+        (file object, cache path, level), or (None, None, None) if nothing usable is cached.
+    """
+    for level in levels:
+        for tier in templates.TIERS:
+            cache_file = entry_path(kind, key, tier, output_format, level)
+            cached = open_cached(cache_file)
+            if cached is None:
+                continue
+            if os.fstat(cached.fileno()).st_size <= limit:
+                return cached, cache_file, level
+            cached.close()
+    return None, None, None
+
+
+def publish(src_path, cache_file):
+    """
+    Atomically copy a rendered file into the cache.
+
+    The data is written to a hidden temp file in the cache directory (same
+    filesystem, so the rename is atomic), flushed to disk and then renamed over
+    `cache_file`.
+    """
+    directory = os.path.dirname(cache_file) or '.'
+    os.makedirs(directory, exist_ok=True)
+    temp_file = os.path.join(directory, f'.{os.path.basename(cache_file)}.{uuid.uuid4().hex}.tmp')
+
+    try:
+        with open(src_path, 'rb') as src, open(temp_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_file)
+        raise
+
+
+def _is_entry_of(cache_file, key_path):
+    return cache_file.startswith(key_path) and cache_file[len(key_path):len(key_path) + 1] in ('.', '_')
+
+
+def prune(pattern, keep_prefix, logger=None):
+    """
+    Remove old cache entries matching `pattern`, except those of the key `keep_prefix`.
+
+    Entries of a key are `keep_prefix` followed by the extension or by a suffix
+    (see entry_path), so another key that merely starts the same way (avatar
+    hashes can start with a default avatar's digit) is still removed.
+
+    Entries that are currently locked (being re-rendered by some replica) are left
+    alone, and entries that disappear underneath us are ignored.
+    """
+    for old_cache in glob.glob(pattern):
+        if _is_entry_of(old_cache, keep_prefix) or old_cache.endswith((LOCK_SUFFIX, '.stale')):
+            continue
+        if os.path.exists(old_cache + LOCK_SUFFIX):
+            continue
+        try:
+            os.remove(old_cache)
+            if logger is not None:
+                logger.info(f"Removed old cache: {old_cache}")
+        except OSError:
+            pass
+
+
+class RenderLock:
+    """
+    Advisory lock file for a single cache entry.
+
+    The lock file is created with O_EXCL, so exactly one replica can hold it. It
+    contains "<hostname> <pid> <token>" so the holder can tell its own lock apart
+    from one that replaced it after being judged stale.
+    """
+
+    def __init__(self, cache_file, stale_after=LOCK_STALE_AFTER):
+        self.path = cache_file + LOCK_SUFFIX
+        self.stale_after = stale_after
+        self.token = None
+
+    def try_acquire(self):
+        """Try to take the lock once, breaking it first if it is stale. Returns True on success."""
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_if_stale():
+                    return False
+                continue
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                continue
+
+            token = uuid.uuid4().hex
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'{HOSTNAME} {os.getpid()} {token}')
+            self.token = token
+            return True
+        return False
+
+    def acquire(self):
+        """Block until the lock is held."""
+        while not self.try_acquire():
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def refresh(self):
+        """Bump the lock's mtime so other replicas don't consider it stale."""
+        if self.token is not None:
+            with contextlib.suppress(OSError):
+                os.utime(self.path)
+
+    def release(self):
+        """Remove the lock file, but only if it is still ours."""
+        if self.token is None:
+            return
+        if self._read() == self._owner_line():
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
+        self.token = None
+
+    def _owner_line(self):
+        return f'{HOSTNAME} {os.getpid()} {self.token}'
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _is_stale(self, content, mtime):
+        if time.time() - mtime > self.stale_after:
+            return True
+
+        # Same host: we can check whether the holder process still exists
+        try:
+            host, pid, _ = content.split(' ', 2)
+        except (AttributeError, ValueError):
+            # Holder hasn't written its line yet (or wrote garbage); give it the full timeout
+            return False
+        if host != HOSTNAME:
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            return False
+        return False
+
+    def _break_if_stale(self):
+        content = self._read()
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            # Released between our open() and now - just retry
+            return True
+        if not self._is_stale(content, mtime):
+            return False
+
+        # Move the lock aside before deleting it; if somebody else broke it and took
+        # a fresh one in the meantime, put theirs back instead of deleting it.
+        tombstone = f'{self.path}.{uuid.uuid4().hex}.stale'
+        try:
+            os.rename(self.path, tombstone)
+        except FileNotFoundError:
+            return True
+        try:
+            with open(tombstone) as f:
+                moved = f.read()
+        except OSError:
+            moved = content
+        if moved != content:
+            with contextlib.suppress(OSError):
+                os.link(tombstone, self.path)
+        with contextlib.suppress(OSError):
+            os.remove(tombstone)
+        return moved == content
+
+
+@contextlib.asynccontextmanager
+async def render_lock(cache_file, logger=None):
+    """
+    Hold the render lock for `cache_file` without blocking the event loop.
+
+    Waits (polling) while another replica holds the lock. Callers should check the
+    cache again once inside, since the previous holder most likely just published
+    the entry they were about to render. The lock file itself is handled in worker
+    threads, since the cache may live on a slow shared volume.
+    """
+    lock = RenderLock(cache_file)
+    waited = False
+    while not await asyncio.to_thread(lock.try_acquire):
+        if not waited and logger is not None:
+            logger.info(f"Waiting for another worker to finish rendering {cache_file}")
+        waited = True
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(lock.stale_after / 4)
+            await asyncio.to_thread(lock.refresh)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        yield lock
+    finally:
+        heartbeat_task.cancel()
+        await asyncio.to_thread(lock.release)
@@ -1,17 +1,14 @@
 import asyncio
-import glob
 import logging
 from pathlib import Path
 import os
 import random
-import shutil
-import subprocess
 import sqlite3
+import uuid
 
 import discord
-import numpy as np
-from PIL import Image, ImageSequence, ImageFilter
-from PIL.Image import Palette
+
+from src import avatars, cache, dispatch, files, formats, looplag, memory, pipeline, quality, sprites, templates, tiers
 
 
 def replace_green_square_in_gif(
@@ -22,144 +19,75 @@ def replace_green_square_in_gif(
         gifsicle_lossy=30,
         blur_radius=0.5,
         colors=60,
+        tier=100,
+        output_format='gif',
+        frame_step=1,
+        frame_workers=1,
 ):
     """
     Replace green screen area in a GIF with a custom image.
 
     Args:
         boiler_template: Path to template GIF with green square
-        image_path: Path to image to insert
-        output_path: Path to save output GIF
+        image_path: Path to image to insert, an already decoded PIL image, an avatars.AnimatedAvatar or a sprites.SpriteSet
+        output_path: Path to save output file
         size: Optional tuple (width, height) for image size. If None, auto-detect from green area
         gifsicle_lossy: Lossy compression level for gifsicle (0-200, higher = smaller/lossier). Set to None to skip.
         blur_radius: Gaussian blur radius applied to the insert image to reduce compression-hostile detail. Set to 0 to skip.
         colors: Number of colors in the palette
+        tier: Template tier (scale in percent, see templates.TIERS) to render at
+        output_format: Output format name (see formats.FORMATS); colors and gifsicle_lossy only apply to GIF
+        frame_step: Keep only every n-th frame (for renders in a hurry, see quality.LADDER)
+        frame_workers: Frames to composite and quantize in parallel, or a callable checked
+            every frame (see pipeline.map_frames and dispatch.frame_workers)
     """
-    # Load the template GIF and the image to insert
-    template = Image.open(boiler_template)
-    insert_image = Image.open(image_path).convert('RGBA')
-
-    frames = []
-    durations = []
-
-    # Detect the size from the largest green area across all frames
-    max_size = (0, 0)
-    max_green_pixels = 0
-
-    if size is None:
-        for frame in ImageSequence.Iterator(template):
-            test_frame = frame.convert('RGBA')
-            test_array = np.array(test_frame)
-            test_mask = (
-                    (test_array[:, :, 1] > 200) &
-                    (test_array[:, :, 0] < 100) &
-                    (test_array[:, :, 2] < 100)
-            )
-            green_count = np.sum(test_mask)
-
-            if green_count > max_green_pixels:
-                max_green_pixels = green_count
-
-            if green_count > 0:
-                rows = np.any(test_mask, axis=1)
-                cols = np.any(test_mask, axis=0)
-                if rows.any() and cols.any():
-                    y_min, y_max = np.where(rows)[0][[0, -1]]
-                    x_min, x_max = np.where(cols)[0][[0, -1]]
-                    frame_size = (int(x_max - x_min + 1), int(y_max - y_min + 1))
-                    if frame_size[0] * frame_size[1] > max_size[0] * max_size[1]:
-                        max_size = frame_size
-
-    # Keep original image for per-frame resizing
-    insert_image_original = insert_image.copy()
-
-    # Process each frame
-    for frame in ImageSequence.Iterator(template):
-        frame = frame.convert('RGBA')
-        frame_array = np.array(frame)
-
-        green_mask = (
-                (frame_array[:, :, 1] > 200) &
-                (frame_array[:, :, 0] < 100) &
-                (frame_array[:, :, 2] < 100)
-        )
-
-        green_count = np.sum(green_mask)
-
-        if green_count > 0:
-            rows = np.any(green_mask, axis=1)
-            cols = np.any(green_mask, axis=0)
-
-            if rows.any() and cols.any():
-                y_min, y_max = np.where(rows)[0][[0, -1]]
-                x_min, x_max = np.where(cols)[0][[0, -1]]
-                pos_this_frame = (int(x_min), int(y_min))
-                size_this_frame = (int(x_max - x_min + 1), int(y_max - y_min + 1))
-
-                insert_image_for_frame = insert_image_original.resize(
-                    size_this_frame, Image.Resampling.LANCZOS
-                )
-
-                # Slight blur to reduce compression-hostile detail from the insert image
-                if blur_radius and blur_radius > 0:
-                    insert_image_for_frame = insert_image_for_frame.filter(
-                        ImageFilter.GaussianBlur(radius=blur_radius)
-                    )
-
-                result = frame.copy()
-                result.paste(insert_image_for_frame, pos_this_frame, insert_image_for_frame)
-                frame_with_insert = result
-            else:
-                frame_with_insert = frame
-        else:
-            frame_with_insert = frame
-
-        # Convert back to P mode (palette) for smaller file size, matching original GIF format
-        frame_with_insert = frame_with_insert.convert('RGB').convert(
-            'P', palette=Palette.ADAPTIVE, colors=colors
+    # The tier's template and its slot track (where the green square is on each frame)
+    template_path, template_info = templates.load_tier(boiler_template, tier)
+
+    # Static avatars look the same on duplicate template frames, so each run of
+    # them is composited once; animated ones move and need every frame
+    frame_plan = None
+    if not isinstance(image_path, avatars.AnimatedAvatar):
+        frame_plan = template_info.frame_plan
+        template_info = template_info.merged()
+
+    with memory.track_render('boiler', template_path) as stats:
+        # Load the image to insert; the template itself is streamed frame by frame
+        insert_track = sprites.insert_sprites(image_path, template_info, blur_radius)
+        stats.avatar_sizes.append(avatars.image_size(image_path))
+
+        def paste(job):
+            # The insert track gives the avatar sprites to use on each frame
+            (frame, duration), insert_sprites, green_box = job
+            if green_box is not None:
+                frame = pipeline.paste_sprite(frame, insert_sprites.sprite(green_box[1], blur_radius), green_box[0])
+
+            return frame, duration
+
+        def composite(template_frames):
+            # Frames don't depend on each other, so several can be pasted at once
+            jobs = zip(template_frames, insert_track, template_info.slots['green'])
+            return pipeline.map_frames(paste, jobs, frame_workers)
+
+        # decode -> composite -> (decimate) -> (GIF: quantize to a palette) -> encode, one frame at a time
+        stats.frames = pipeline.encode(
+            pipeline.decimate(composite(pipeline.decode_frames(template_path, frame_plan)), frame_step),
+            output_path,
+            formats.get_format(output_format),
+            colors,
+            gifsicle_lossy,
+            frame_workers,
         )
 
-        frames.append(frame_with_insert)
-        durations.append(frame.info.get('duration', 100))
-
-    # Save as new GIF with optimization
-    frames[0].save(
-        output_path,
-        save_all=True,
-        append_images=frames[1:],
-        duration=durations,
-        loop=0,
-        disposal=2,
-        optimize=True,
-        colors=colors,
-    )
-
-    if gifsicle_lossy is not None and shutil.which('gifsicle'):
-        try:
-            subprocess.run(
-                [
-                    'gifsicle',
-                    '--optimize=3',
-                    f'--lossy={gifsicle_lossy}',
-                    '--colors', str(colors),
-                    str(output_path),
-                    '-o', str(output_path),
-                ],
-                check=True,
-                capture_output=True,
-            )
-        except subprocess.CalledProcessError as e:
-            print(f"gifsicle optimization failed (non-fatal): {e.stderr.decode()}")
-    elif gifsicle_lossy is not None:
-        print("gifsicle not found on PATH — skipping post-processing optimization")
-
 
+@looplag.handler
 async def boiler(
         interaction:discord.Interaction,
         user:discord.User,
         boiler_template:Path,
         # boilboard_db:Path,
-        logger:logging.Logger
+        logger:logging.Logger,
+        output_format=None
 ):
     # If no user specified, use the command author
     gotcha = False
@@ -180,85 +108,164 @@ async def boiler(
     target_name = user.display_name or user.name
     logger.info(f"Boil request: {requester_name} wants to boil {target_name}'s avatar")
 
+    temp_output = None
     try:
         # Get avatar hash for cache key
         avatar_hash = user.display_avatar.key
-        cache_file = f'cache/boiler/{user.id}_{avatar_hash}.gif'
+        animated = avatars.wants_animated(user.display_avatar)
+        if animated:
+            # Keep animated renders apart from older first-frame-only renders of the same avatar
+            avatar_hash += '_anim'
+        cache_key = f'{user.id}_{avatar_hash}'
+        limit = tiers.upload_limit(interaction)
+        output_format = formats.select_format(interaction, output_format)
+        deadline_at = quality.deadline(interaction)
+
+        def schedule_upgrade(degraded_file):
+            # Re-render a degraded result at full quality once the renderer is idle
+            full_tier = tiers.select_tier(boiler_template, limit, 0, output_format.name)
+            template_path = templates.tier_path(boiler_template, full_tier)
+
+            async def render(output_path):
+                _, template_info = await asyncio.to_thread(templates.load_tier, boiler_template, full_tier)
+                avatar_size = avatars.request_size(template_info.max_slot_size('green'))
+                avatar = await sprites.fetch_sprite_set(
+                    user.display_avatar, template_path, avatar_size, logger, animated
+                )
+                await dispatch.run_render(
+                    replace_green_square_in_gif,
+                    boiler_template,
+                    avatar,
+                    output_path,
+                    tier=full_tier,
+                    output_format=output_format.name,
+                    template=template_path,
+                    frame_workers=dispatch.frame_workers,
+                )
+                return await files.getsize(output_path) <= limit
 
-        # Check if cached version exists
-        if os.path.exists(cache_file):
-            logger.info(f"Using cached GIF for {target_name} (hash: {avatar_hash})")
+            full_cache_file = cache.entry_path('boiler', cache_key, full_tier, output_format)
+            quality.upgrade_later(full_cache_file, degraded_file, render, logger)
+
+        # Check if a cached version (of any tier that we can upload here) exists, degraded ones last
+        cached, cache_file, cached_level = await asyncio.to_thread(
+            cache.open_best_cached, 'boiler', cache_key, limit, output_format, quality.LEVELS
+        )
+        if cached is not None:
+            logger.info(f"Using cached render for {target_name} (hash: {avatar_hash})")
+            if cached_level:
+                schedule_upgrade(cache_file)
 
             await interaction.followup.send(
                 content=content,
-                file=discord.File(cache_file)
+                file=await files.discord_file(cached, os.path.basename(cache_file))
             )
             return
 
-        # Not cached - process new avatar
-        logger.info(f"No cache found, processing new avatar for {target_name}")
-
-        # Get the user's avatar URL (highest quality)
-        avatar_url = user.display_avatar.url
-        logger.info(f"Downloading avatar from: {avatar_url}")
-
-        # Download the avatar
-        temp_input = f'temp/input_{interaction.user.id}_{user.id}.png'
-        temp_output = f'temp/output_{interaction.user.id}_{user.id}.gif'
-
-        # Save the avatar image
-        try:
-            await user.display_avatar.save(temp_input)
-            avatar_size = os.path.getsize(temp_input)
-            logger.info(f"Avatar downloaded: {avatar_size / 1024:.1f} KB")
-        except Exception as e:
-            logger.error(f"Failed to download avatar: {e}")
-            await interaction.followup.send(f"❌ Failed to download avatar: {e}")
-            return
-
-        # Process the image (run in executor to avoid blocking)
-        await asyncio.to_thread(
-            replace_green_square_in_gif,
-            boiler_template,
-            temp_input,
-            temp_output
-        )
-
-        # Check file size (Discord limit is 25MB for non-Nitro users)
-        file_size = os.path.getsize(temp_output)
-        file_size_mb = file_size / (1024 * 1024)
-        logger.info(f"Output GIF size: {file_size_mb:.2f} MB")
+        # Pick a template tier for the upload limit and current load
+        load = dispatch.running + dispatch.queued()
+        tier = tiers.select_tier(boiler_template, limit, load, output_format.name)
+        # ... and lower the quality if a full quality render wouldn't be done in time
+        tier, level = quality.plan(boiler_template, tier, output_format.name, deadline_at, load)
+        if level:
+            logger.info(f"Rendering at reduced quality ({quality.LADDER[level].name}) to meet the deadline")
+        cache_file = cache.entry_path('boiler', cache_key, tier, output_format, level)
+        # Renders of the same pair at different tiers or levels can run at once, each needs its own file
+        output_name = f'output_{interaction.user.id}_{user.id}.{output_format.ext}'
+        temp_output = f'temp/output_{uuid.uuid4().hex}.{output_format.ext}'
+
+        # Only one worker (across all replicas sharing the cache) renders a given key
+        async with cache.render_lock(cache_file, logger):
+            cached = await asyncio.to_thread(cache.open_cached, cache_file)
+            if cached is None:
+                # Not cached - process new avatar
+                logger.info(f"No cache found, processing new avatar for {target_name} at {tier}%")
+
+                # Download the avatar at the smallest size the template's slot needs
+                _, template_info = await asyncio.to_thread(templates.load_tier, boiler_template, tier)
+                avatar_size = avatars.request_size(template_info.max_slot_size('green'))
+
+                while True:
+                    # Avatar sprites scaled for this tier before are reused, otherwise download the avatar
+                    template_path = templates.tier_path(boiler_template, tier)
+                    try:
+                        avatar = await sprites.fetch_sprite_set(
+                            user.display_avatar, template_path, avatar_size, logger, animated
+                        )
+                    except Exception as e:
+                        logger.error(f"Failed to download avatar: {e}")
+                        await interaction.followup.send(f"❌ Failed to download avatar: {e}")
+                        return
+
+                    # Process the image (in a worker thread, once there's memory for it)
+                    _, seconds = await dispatch.run_timed_render(
+                        replace_green_square_in_gif,
+                        boiler_template,
+                        avatar,
+                        temp_output,
+                        tier=tier,
+                        output_format=output_format.name,
+                        template=template_path,
+                        frame_workers=dispatch.frame_workers,
+                        **quality.LADDER[level].render_kwargs(),
+                    )
+                    quality.record_cost(boiler_template, tier, output_format.name, level, seconds)
+                    await asyncio.to_thread(sprites.store, user.display_avatar.key, template_path, avatar, logger)
+
+                    # Check file size against what we're allowed to upload here
+                    file_size = await files.getsize(temp_output)
+                    file_size_mb = file_size / (1024 * 1024)
+                    logger.info(f"Output {output_format.name} size: {file_size_mb:.2f} MB")
+                    if not level:
+                        # Degraded renders are smaller and would make full quality ones look like they fit
+                        tiers.record_output_size(boiler_template, tier, file_size, output_format.name)
+
+                    if file_size <= limit:
+                        break
+
+                    # Too large - try again at the next lower tier, if there is one
+                    smaller = tiers.lower_tier(tier)
+                    if smaller is None:
+                        await interaction.followup.send(
+                            f"❌ The output {output_format.ext.upper()} is too large ({file_size_mb:.1f} MB)! "
+                            f"The upload limit here is {limit / (1024 * 1024):.0f} MB."
+                        )
+                        # Clean up
+                        await files.remove(temp_output)
+                        return
+
+                    logger.info(f"Output too large for the upload limit, re-rendering at {smaller}%")
+                    tier = smaller
+
+                published_file = cache.entry_path('boiler', cache_key, tier, output_format, level)
+                if published_file == cache_file:
+                    await asyncio.to_thread(cache.publish, temp_output, cache_file)
+                else:
+                    # Fell back to a lower tier, whose entry the lock held so far doesn't cover
+                    async with cache.render_lock(published_file, logger):
+                        await asyncio.to_thread(cache.publish, temp_output, published_file)
+                    cache_file = published_file
+                logger.info(f"Saved to cache: {cache_file}")
+
+                # Clean up old cached versions for this user (different avatar hashes)
+                await asyncio.to_thread(cache.prune, f'cache/boiler/{user.id}_*', f'cache/boiler/{cache_key}', logger)
+
+        if cached is not None:
+            logger.info(f"Using render by another worker for {target_name} (hash: {avatar_hash})")
 
-        if file_size_mb > 24:  # Leave some margin
             await interaction.followup.send(
-                f"❌ The output GIF is too large ({file_size_mb:.1f} MB)! "
-                f"Discord's limit is 25 MB. Please use a smaller/shorter template GIF."
+                content=content,
+                file=await files.discord_file(cached, os.path.basename(cache_file))
             )
-            # Clean up
-            try:
-                os.remove(temp_input)
-                os.remove(temp_output)
-            except FileNotFoundError or OSError:
-                pass
             return
 
-        shutil.copy(temp_output, cache_file)
-        logger.info(f"Saved to cache: {cache_file}")
-
-        # Clean up old cached versions for this user (different avatar hashes)
-        for old_cache in glob.glob(f'cache/boiler/{user.id}_*.gif'):
-            if old_cache != cache_file:
-                try:
-                    os.remove(old_cache)
-                    logger.info(f"Removed old cache: {old_cache}")
-                except FileNotFoundError or OSError:
-                    pass
-
         # Send the result
         await interaction.followup.send(
             content=content,
-            file=discord.File(temp_output)
+            file=await files.discord_file(temp_output, output_name)
         )
+        if level:
+            schedule_upgrade(cache_file)
 
         # # TODO: use user_id instead of name? how to covert?
         # #       figure out how to render/embed tables in discord
@@ -284,12 +291,10 @@ async def boiler(
             # close db con
 
         # Clean up temp files
-        try:
-            os.remove(temp_input)
-            os.remove(temp_output)
-        except FileNotFoundError or OSError:
-            pass
+        await files.remove(temp_output)
 
     except Exception as e:
         await interaction.followup.send(f"❌ Error processing image: {str(e)}")
-        logger.error(f"Error: {e}")
\ No newline at end of file
+        logger.error(f"Error: {e}")
+        if temp_output is not None:
+            await files.remove(temp_output)
\ No newline at end of file
@@ -1,17 +1,14 @@
 import asyncio
-import glob
 import logging
 from pathlib import Path
 import os
 import random
-import shutil
-import subprocess
 # import sqlite3
+import uuid
 
 import discord
-import numpy as np
-from PIL import Image, ImageSequence, ImageFilter
-from PIL.Image import Palette
+
+from src import avatars, cache, dispatch, files, formats, looplag, memory, pipeline, quality, sprites, templates, tiers
 
 
 def replace_color_squares_in_gif(
@@ -22,6 +19,10 @@ def replace_color_squares_in_gif(
         gifsicle_lossy=30,
         blur_radius=0.5,
         colors=256,
+        tier=100,
+        output_format='gif',
+        frame_step=1,
+        frame_workers=1,
 ):
     """
     Replace colored screen areas in a GIF with custom images.
@@ -31,136 +32,74 @@ def replace_color_squares_in_gif(
 
     Args:
         framemog_template: Path to template GIF with green and purple squares
-        image_path_mogger: Path to image to insert into the purple square
-        image_path_moggee: Path to image to insert into the green square
-        output_path: Path to save output GIF
+        image_path_mogger: Path to image (or decoded PIL image / avatars.AnimatedAvatar / sprites.SpriteSet) to insert into the purple square
+        image_path_moggee: Path to image (or decoded PIL image / avatars.AnimatedAvatar / sprites.SpriteSet) to insert into the green square
+        output_path: Path to save output file
         gifsicle_lossy: Lossy compression level for gifsicle (0-200, higher = smaller/lossier). Set to None to skip.
         blur_radius: Gaussian blur radius applied to the insert images to reduce compression-hostile detail. Set to 0 to skip.
         colors: Number of colors in the palette
+        tier: Template tier (scale in percent, see templates.TIERS) to render at
+        output_format: Output format name (see formats.FORMATS); colors and gifsicle_lossy only apply to GIF
+        frame_step: Keep only every n-th frame (for renders in a hurry, see quality.LADDER)
+        frame_workers: Frames to composite and quantize in parallel, or a callable checked
+            every frame (see pipeline.map_frames and dispatch.frame_workers)
     """
-    # Load the template GIF and the images to insert
-    template = Image.open(framemog_template)
-    mogger_image = Image.open(image_path_mogger).convert('RGBA')
-    moggee_image = Image.open(image_path_moggee).convert('RGBA')
-
-    frames = []
-    durations = []
-
-    # Keep originals for per-frame resizing
-    mogger_original = mogger_image.copy()
-    moggee_original = moggee_image.copy()
-
-    def make_green_mask(arr):
-        """Detect #00ff00 green pixels."""
-        return (
-            (arr[:, :, 1] > 200) &
-            (arr[:, :, 0] < 100) &
-            (arr[:, :, 2] < 100)
-        )
-
-    def make_purple_mask(arr):
-        """Detect #ff00ff purple/magenta pixels."""
-        return (
-            (arr[:, :, 0] > 200) &
-            (arr[:, :, 1] < 100) &
-            (arr[:, :, 2] > 200)
+    # The tier's template and its slot tracks (where the squares are on each frame)
+    template_path, template_info = templates.load_tier(framemog_template, tier)
+
+    # Static avatars look the same on duplicate template frames, so each run of
+    # them is composited once; animated ones move and need every frame
+    frame_plan = None
+    if not any(isinstance(image, avatars.AnimatedAvatar) for image in (image_path_mogger, image_path_moggee)):
+        frame_plan = template_info.frame_plan
+        template_info = template_info.merged()
+
+    with memory.track_render('framemog', template_path) as stats:
+        # Load the images to insert; the template itself is streamed frame by frame
+        mogger_track = sprites.insert_sprites(image_path_mogger, template_info, blur_radius)
+        moggee_track = sprites.insert_sprites(image_path_moggee, template_info, blur_radius)
+        stats.avatar_sizes += [avatars.image_size(image_path_mogger), avatars.image_size(image_path_moggee)]
+
+        def paste(job):
+            # The insert tracks give the avatar sprites to use on each frame
+            (frame, duration), mogger_sprites, moggee_sprites, (green_box, purple_box) = job
+
+            # Paste moggee into green square
+            if green_box is not None:
+                frame = pipeline.paste_sprite(frame, moggee_sprites.sprite(green_box[1], blur_radius), green_box[0])
+
+            # Paste mogger into purple square
+            if purple_box is not None:
+                frame = pipeline.paste_sprite(frame, mogger_sprites.sprite(purple_box[1], blur_radius), purple_box[0])
+
+            return frame, duration
+
+        def composite(template_frames):
+            # Frames don't depend on each other, so several can be pasted at once
+            slot_boxes = zip(template_info.slots['green'], template_info.slots['purple'])
+            jobs = zip(template_frames, mogger_track, moggee_track, slot_boxes)
+            return pipeline.map_frames(paste, jobs, frame_workers)
+
+        # decode -> composite -> (decimate) -> (GIF: quantize to a palette) -> encode, one frame at a time
+        stats.frames = pipeline.encode(
+            pipeline.decimate(composite(pipeline.decode_frames(template_path, frame_plan)), frame_step),
+            output_path,
+            formats.get_format(output_format),
+            colors,
+            gifsicle_lossy,
+            frame_workers,
         )
 
-    def find_bounding_box(mask):
-        """Find bounding box of a boolean mask. Returns (pos, size) or None."""
-        rows = np.any(mask, axis=1)
-        cols = np.any(mask, axis=0)
-        if not rows.any() or not cols.any():
-            return None
-        y_min, y_max = np.where(rows)[0][[0, -1]]
-        x_min, x_max = np.where(cols)[0][[0, -1]]
-        pos = (int(x_min), int(y_min))
-        size = (int(x_max - x_min + 1), int(y_max - y_min + 1))
-        return pos, size
-
-    def paste_into_region(frame, insert_original, mask, blur_rad):
-        """Resize and paste an image into the region defined by the mask."""
-        bbox = find_bounding_box(mask)
-        if bbox is None:
-            return frame
-
-        pos, region_size = bbox
-
-        resized = insert_original.resize(region_size, Image.Resampling.LANCZOS)
-
-        if blur_rad and blur_rad > 0:
-            resized = resized.filter(ImageFilter.GaussianBlur(radius=blur_rad))
-
-        result = frame.copy()
-        result.paste(resized, pos, resized)
-        return result
-
-    # Process each frame
-    for frame in ImageSequence.Iterator(template):
-        frame = frame.convert('RGBA')
-        frame_array = np.array(frame)
-
-        green_mask = make_green_mask(frame_array)
-        purple_mask = make_purple_mask(frame_array)
-
-        result = frame
-
-        # Paste moggee into green square
-        if np.sum(green_mask) > 0:
-            result = paste_into_region(result, moggee_original, green_mask, blur_radius)
-
-        # Paste mogger into purple square
-        if np.sum(purple_mask) > 0:
-            result = paste_into_region(result, mogger_original, purple_mask, blur_radius)
-
-        # Convert back to P mode (palette) for smaller file size
-        result = result.convert('RGB').convert(
-            'P', palette=Palette.ADAPTIVE, colors=colors
-        )
-
-        frames.append(result)
-        durations.append(frame.info.get('duration', 100))
-
-    # Save as new GIF with optimization
-    frames[0].save(
-        output_path,
-        save_all=True,
-        append_images=frames[1:],
-        duration=durations,
-        loop=0,
-        disposal=2,
-        optimize=True,
-        colors=colors,
-    )
-
-    # gifsicle post-processing for frame differencing and lossy compression
-    if gifsicle_lossy is not None and shutil.which('gifsicle'):
-        try:
-            subprocess.run(
-                [
-                    'gifsicle',
-                    '--optimize=3',
-                    f'--lossy={gifsicle_lossy}',
-                    '--colors', str(colors),
-                    str(output_path),
-                    '-o', str(output_path),
-                ],
-                check=True,
-                capture_output=True,
-            )
-        except subprocess.CalledProcessError as e:
-            print(f"gifsicle optimization failed (non-fatal): {e.stderr.decode()}")
-    elif gifsicle_lossy is not None:
-        print("gifsicle not found on PATH — skipping post-processing optimization")
-
 
+@looplag.handler
 async def framemogger(
         interaction:discord.Interaction,
         user:discord.User,
         mog_location,
         framemog_template:Path,
         # boilboard_db:Path,
-        logger:logging.Logger
+        logger:logging.Logger,
+        output_format=None
 ):
     if mog_location is None and interaction.guild.name is None:
         mog_location = "ASU"
@@ -186,95 +125,168 @@ async def framemogger(
     target_name = target.display_name or target.name
     logger.info(f"Framemog request: {requester_name} wants to framemog {target_name}'s avatar")
 
+    temp_output = None
     try:
         # Get avatar hash for cache key
         avatar_hash = target.display_avatar.key + "_" + caller.display_avatar.key
+        animated = avatars.wants_animated(target.display_avatar) or avatars.wants_animated(caller.display_avatar)
+        if animated:
+            # Keep animated renders apart from older first-frame-only renders of the same avatars
+            avatar_hash += '_anim'
         user_ids = str(target.id) + "_" + str(caller.id)
-        cache_file = f'cache/framemog/{user_ids}_{avatar_hash}.gif'
-
-        # Check if cached version exists
-        if os.path.exists(cache_file):
-            logger.info(f"Using cached GIF for {target_name} and {requester_name} (hash: {avatar_hash})")
+        cache_key = f'{user_ids}_{avatar_hash}'
+        limit = tiers.upload_limit(interaction)
+        output_format = formats.select_format(interaction, output_format)
+        deadline_at = quality.deadline(interaction)
+
+        def schedule_upgrade(degraded_file):
+            # Re-render a degraded result at full quality once the renderer is idle
+            full_tier = tiers.select_tier(framemog_template, limit, 0, output_format.name)
+            template_path = templates.tier_path(framemog_template, full_tier)
+
+            async def render(output_path):
+                _, template_info = await asyncio.to_thread(templates.load_tier, framemog_template, full_tier)
+                avatar_size = avatars.request_size(template_info.max_slot_size('green', 'purple'))
+                mogger_avatar, moggee_avatar = await sprites.fetch_sprite_sets(
+                    [caller.display_avatar, target.display_avatar], template_path, avatar_size, logger, animated
+                )
+                await dispatch.run_render(
+                    replace_color_squares_in_gif,
+                    framemog_template,
+                    mogger_avatar,
+                    moggee_avatar,
+                    output_path,
+                    tier=full_tier,
+                    output_format=output_format.name,
+                    template=template_path,
+                    frame_workers=dispatch.frame_workers,
+                )
+                return await files.getsize(output_path) <= limit
+
+            full_cache_file = cache.entry_path('framemog', cache_key, full_tier, output_format)
+            quality.upgrade_later(full_cache_file, degraded_file, render, logger)
+
+        # Check if a cached version (of any tier that we can upload here) exists, degraded ones last
+        cached, cache_file, cached_level = await asyncio.to_thread(
+            cache.open_best_cached, 'framemog', cache_key, limit, output_format, quality.LEVELS
+        )
+        if cached is not None:
+            logger.info(f"Using cached render for {target_name} and {requester_name} (hash: {avatar_hash})")
+            if cached_level:
+                schedule_upgrade(cache_file)
 
             await interaction.followup.send(
                 content=content,
-                file=discord.File(cache_file)
+                file=await files.discord_file(cached, os.path.basename(cache_file))
             )
             return
 
-        # Not cached - process new avatar
-        logger.info(f"No cache found, processing new avatars for {target_name} and {requester_name}")
-
-        # Get the user's avatar URL (highest quality)
-        avatar_url_mogger = target.display_avatar.url
-        avatar_url_moggee = caller.display_avatar.url
-        logger.info(f"Downloading avatar from: {avatar_url_mogger}")
-        logger.info(f"Downloading avatar from: {avatar_url_moggee}")
-
-        # Download the avatar
-        temp_input_mogger = f'temp/input_{caller.id}.png'
-        temp_input_moggee = f'temp/input_{target.id}.png'
-        temp_output = f'temp/output_{caller.id}_{target.id}.gif'
-
-        # Save the avatar image
-        try:
-            await caller.display_avatar.save(temp_input_mogger)
-            avatar_size = os.path.getsize(temp_input_mogger)
-            logger.info(f"Avatar downloaded: {avatar_size / 1024:.1f} KB")
-
-            await target.display_avatar.save(temp_input_moggee)
-            avatar_size = os.path.getsize(temp_input_moggee)
-            logger.info(f"Avatar downloaded: {avatar_size / 1024:.1f} KB")
-        except Exception as e:
-            logger.error(f"Failed to download avatar: {e}")
-            await interaction.followup.send(f"❌ Failed to download avatar: {e}")
-            return
-
-        # Process the image (run in executor to avoid blocking)
-        await asyncio.to_thread(
-            replace_color_squares_in_gif,
-            framemog_template,
-            temp_input_mogger,
-            temp_input_moggee,
-            temp_output
-        )
-
-        # Check file size (Discord limit is 25MB for non-Nitro users)
-        file_size = os.path.getsize(temp_output)
-        file_size_mb = file_size / (1024 * 1024)
-        logger.info(f"Output GIF size: {file_size_mb:.2f} MB")
+        # Pick a template tier for the upload limit and current load
+        load = dispatch.running + dispatch.queued()
+        tier = tiers.select_tier(framemog_template, limit, load, output_format.name)
+        # ... and lower the quality if a full quality render wouldn't be done in time
+        tier, level = quality.plan(framemog_template, tier, output_format.name, deadline_at, load)
+        if level:
+            logger.info(f"Rendering at reduced quality ({quality.LADDER[level].name}) to meet the deadline")
+        cache_file = cache.entry_path('framemog', cache_key, tier, output_format, level)
+        # Renders of the same pair at different tiers or levels can run at once, each needs its own file
+        output_name = f'output_{caller.id}_{target.id}.{output_format.ext}'
+        temp_output = f'temp/output_{uuid.uuid4().hex}.{output_format.ext}'
+
+        # Only one worker (across all replicas sharing the cache) renders a given key
+        async with cache.render_lock(cache_file, logger):
+            cached = await asyncio.to_thread(cache.open_cached, cache_file)
+            if cached is None:
+                # Not cached - process new avatar
+                logger.info(f"No cache found, processing new avatars for {target_name} and {requester_name} at {tier}%")
+
+                # Download both avatars at once, at the smallest size the template's slots need
+                _, template_info = await asyncio.to_thread(templates.load_tier, framemog_template, tier)
+                avatar_size = avatars.request_size(template_info.max_slot_size('green', 'purple'))
+
+                while True:
+                    # Avatar sprites scaled for this tier before (for any pair) are reused, the rest is downloaded
+                    template_path = templates.tier_path(framemog_template, tier)
+                    try:
+                        mogger_avatar, moggee_avatar = await sprites.fetch_sprite_sets(
+                            [caller.display_avatar, target.display_avatar], template_path, avatar_size, logger, animated
+                        )
+                    except Exception as e:
+                        logger.error(f"Failed to download avatar: {e}")
+                        await interaction.followup.send(f"❌ Failed to download avatar: {e}")
+                        return
+
+                    # Process the image (in a worker thread, once there's memory for it)
+                    _, seconds = await dispatch.run_timed_render(
+                        replace_color_squares_in_gif,
+                        framemog_template,
+                        mogger_avatar,
+                        moggee_avatar,
+                        temp_output,
+                        tier=tier,
+                        output_format=output_format.name,
+                        template=template_path,
+                        frame_workers=dispatch.frame_workers,
+                        **quality.LADDER[level].render_kwargs(),
+                    )
+                    quality.record_cost(framemog_template, tier, output_format.name, level, seconds)
+                    await asyncio.to_thread(sprites.store, caller.display_avatar.key, template_path, mogger_avatar, logger)
+                    await asyncio.to_thread(sprites.store, target.display_avatar.key, template_path, moggee_avatar, logger)
+
+                    # Check file size against what we're allowed to upload here
+                    file_size = await files.getsize(temp_output)
+                    file_size_mb = file_size / (1024 * 1024)
+                    logger.info(f"Output {output_format.name} size: {file_size_mb:.2f} MB")
+                    if not level:
+                        # Degraded renders are smaller and would make full quality ones look like they fit
+                        tiers.record_output_size(framemog_template, tier, file_size, output_format.name)
+
+                    if file_size <= limit:
+                        break
+
+                    # Too large - try again at the next lower tier, if there is one
+                    smaller = tiers.lower_tier(tier)
+                    if smaller is None:
+                        await interaction.followup.send(
+                            f"❌ The output {output_format.ext.upper()} is too large ({file_size_mb:.1f} MB)! "
+                            f"The upload limit here is {limit / (1024 * 1024):.0f} MB."
+                        )
+                        # Clean up
+                        await files.remove(temp_output)
+                        return
+
+                    logger.info(f"Output too large for the upload limit, re-rendering at {smaller}%")
+                    tier = smaller
+
+                published_file = cache.entry_path('framemog', cache_key, tier, output_format, level)
+                if published_file == cache_file:
+                    await asyncio.to_thread(cache.publish, temp_output, cache_file)
+                else:
+                    # Fell back to a lower tier, whose entry the lock held so far doesn't cover
+                    async with cache.render_lock(published_file, logger):
+                        await asyncio.to_thread(cache.publish, temp_output, published_file)
+                    cache_file = published_file
+                logger.info(f"Saved to cache: {cache_file}")
+
+                # Clean up old cached versions for this user (different avatar hashes)
+                await asyncio.to_thread(cache.prune, f'cache/framemog/{target.id}_*', f'cache/framemog/{cache_key}', logger)
+
+        if cached is not None:
+            logger.info(f"Using render by another worker for {target_name} and {requester_name} (hash: {avatar_hash})")
 
-        if file_size_mb > 24:  # Leave some margin
             await interaction.followup.send(
-                f"❌ The output GIF is too large ({file_size_mb:.1f} MB)! "
-                f"Discord's limit is 25 MB. Please use a smaller/shorter template GIF."
+                content=content,
+                file=await files.discord_file(cached, os.path.basename(cache_file))
             )
-            # Clean up
-            try:
-                os.remove(temp_input_mogger)
-                os.remove(temp_input_moggee)
-                os.remove(temp_output)
-            except FileNotFoundError or OSError:
-                pass
             return
 
-        shutil.copy(temp_output, cache_file)
-        logger.info(f"Saved to cache: {cache_file}")
-
-        # Clean up old cached versions for this user (different avatar hashes)
-        for old_cache in glob.glob(f'cache/framemog/{target.id}_*.gif'):
-            if old_cache != cache_file:
-                try:
-                    os.remove(old_cache)
-                    logger.info(f"Removed old cache: {old_cache}")
-                except FileNotFoundError or OSError:
-                    pass
-
         # Send the result
         await interaction.followup.send(
             content=content,
-            file=discord.File(temp_output)
+            file=await files.discord_file(temp_output, output_name)
         )
+        if level:
+            schedule_upgrade(cache_file)
 
         # # TODO: use user_id instead of name? how to covert?
         # #       figure out how to render/embed tables in discord
@@ -298,13 +310,10 @@ async def framemogger(
             # close db con
 
         # Clean up temp files
-        try:
-            os.remove(temp_input_mogger)
-            os.remove(temp_input_moggee)
-            os.remove(temp_output)
-        except FileNotFoundError or OSError:
-            pass
+        await files.remove(temp_output)
 
     except Exception as e:
         await interaction.followup.send(f"❌ Error processing image: {str(e)}")
-        logger.error(f"Error: {e}")
\ No newline at end of file
+        logger.error(f"Error: {e}")
+        if temp_output is not None:
+            await files.remove(temp_output)
\ No newline at end of file
@@ -10,6 +10,8 @@ OVER the squished image to create the layered effect.
 from PIL import Image, ImageDraw, ImageFont
 import math
 
+from src import memory, pipeline
+
 
 def create_hand_frame(frame_num, total_frames=10):
     """
@@ -79,56 +81,50 @@ def generate_petpet_gif(input_image_path, output_path='petpet.gif', frames=10, d
         frames: Number of frames in animation
         duration: Duration per frame in milliseconds
     """
-    # Load and prepare the input image
-    pet_img = Image.open(input_image_path).convert('RGBA')
-
-    # Resize to fit the petting area (leave room for hand)
-    pet_size = 90
-    pet_img = pet_img.resize((pet_size, pet_size), Image.Resampling.LANCZOS)
+    with memory.track_render('petter', 'petpet') as stats:
+        # Load and prepare the input image
+        pet_img = Image.open(input_image_path).convert('RGBA')
+        stats.avatar_sizes.append(pet_img.size)
 
-    gif_frames = []
+        # Resize to fit the petting area (leave room for hand)
+        pet_size = 90
+        pet_img = pet_img.resize((pet_size, pet_size), Image.Resampling.LANCZOS)
 
-    for i in range(frames):
-        # Create base canvas
-        frame = Image.new('RGBA', (112, 112), (255, 255, 255, 0))
+        def composite():
+            for i in range(frames):
+                # Create base canvas
+                frame = Image.new('RGBA', (112, 112), (255, 255, 255, 0))
 
-        # Get squish parameters for this frame
-        scale_x, scale_y, offset_y = create_squish_parameters(i, frames)
+                # Get squish parameters for this frame
+                scale_x, scale_y, offset_y = create_squish_parameters(i, frames)
 
-        # Calculate squished dimensions
-        squished_width = int(pet_size * scale_x)
-        squished_height = int(pet_size * scale_y)
+                # Calculate squished dimensions
+                squished_width = int(pet_size * scale_x)
+                squished_height = int(pet_size * scale_y)
 
-        # Squish the pet image
-        squished_pet = pet_img.resize((squished_width, squished_height),
-                                      Image.Resampling.LANCZOS)
+                # Squish the pet image
+                squished_pet = pet_img.resize((squished_width, squished_height),
+                                              Image.Resampling.LANCZOS)
 
-        # Position the squished pet (centered, with offset)
-        pet_x = (112 - squished_width) // 2
-        pet_y = (112 - squished_height) // 2 + offset_y
+                # Position the squished pet (centered, with offset)
+                pet_x = (112 - squished_width) // 2
+                pet_y = (112 - squished_height) // 2 + offset_y
 
-        # STEP 1: Draw the pet image on the base layer
-        frame.paste(squished_pet, (pet_x, pet_y), squished_pet)
+                # STEP 1: Draw the pet image on the base layer
+                frame.paste(squished_pet, (pet_x, pet_y), squished_pet)
 
-        # STEP 2: Draw the hand OVER the pet (this is the key!)
-        hand = create_hand_frame(i, frames)
-        frame = Image.alpha_composite(frame, hand)
+                # STEP 2: Draw the hand OVER the pet (this is the key!)
+                hand = create_hand_frame(i, frames)
+                frame = Image.alpha_composite(frame, hand)
 
-        # Convert to RGB for GIF
-        frame_rgb = Image.new('RGB', (112, 112), (255, 255, 255))
-        frame_rgb.paste(frame, (0, 0), frame)
+                # Convert to RGB for GIF
+                frame_rgb = Image.new('RGB', (112, 112), (255, 255, 255))
+                frame_rgb.paste(frame, (0, 0), frame)
 
-        gif_frames.append(frame_rgb)
+                yield frame_rgb, duration
 
-    # Save as GIF
-    gif_frames[0].save(
-        output_path,
-        save_all=True,
-        append_images=gif_frames[1:],
-        duration=duration,
-        loop=0,
-        optimize=False
-    )
+        # Save as GIF, streaming frames into the file as they are drawn
+        stats.frames = pipeline.write_gif(pipeline.quantize_frames(composite(), colors=256), output_path)
 
     print(f"✅ PetPet GIF saved to: {output_path}")
     print(f"   Frames: {frames}")
@@ -0,0 +1,116 @@
+"""
+Render dispatcher.
+
+Command handlers hand their (blocking) render functions to `run_render`
+instead of calling asyncio.to_thread directly. That's the one place that
+decides when a render may start: it has to be admitted by the memory budget
+first, so bursts queue up instead of getting the container OOM-killed.
+
+Renders run on their own thread pool rather than asyncio's default executor,
+which handlers use for short blocking calls (cache lookups, lock polls, file
+reads, see src/files.py). Otherwise those would queue behind multi-second
+renders whenever a few are running.
+
+`run_timed_render` also reports how long the render itself took, scaled to
+what it would have taken on an idle renderer, for the deadline planner (see
+src/quality.py).
+
+Renders can also spread their frames over the shared frame pool (see
+pipeline.map_frames); `frame_workers` says how far, given what else is
+running.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import os
+import threading
+import time
+
+from src import memory, pipeline
+
+
+CPU_COUNT = os.process_cpu_count() or 1
+# Same default as asyncio's executor, which renders used to share
+RENDER_THREADS = int(os.getenv('RENDER_THREADS', str(min(32, CPU_COUNT + 4))))
+_render_pool = ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix='render')
+
+
+# Renders admitted and running / waiting for admission, for load-aware decisions
+running = 0
+# Integral of `running` over time (render-seconds) up to `_busy_since`, read from render threads
+_busy_seconds = 0.0
+_busy_since = time.perf_counter()
+_busy_lock = threading.Lock()
+
+
+def _busy_now():
+    """Render-seconds spent by all renders so far."""
+    with _busy_lock:
+        return _busy_seconds + running * (time.perf_counter() - _busy_since)
+
+
+def _add_running(delta):
+    global running, _busy_seconds, _busy_since
+
+    with _busy_lock:
+        now = time.perf_counter()
+        _busy_seconds += running * (now - _busy_since)
+        _busy_since = now
+        running += delta
+
+
+def queued():
+    return memory.budget.waiting
+
+
+def frame_workers():
+    """
+    Frames a render may work on in parallel right now.
+
+    The frame pool is split between the renders running, so a render on a
+    quiet bot gets every core and a busy bot falls back to one thread per
+    render. Renders check again every frame.
+    """
+    return max(1, pipeline.FRAME_THREADS // max(running, 1))
+
+
+async def run_render(func, *args, template, **kwargs):
+    """
+    Run `func(*args, **kwargs)` on the render pool once the memory budget admits it.
+
+    Args:
+        func: Blocking render function
+        template: Template being rendered, used to estimate the render's peak memory
+    """
+    result, _ = await run_timed_render(func, *args, template=template, **kwargs)
+    return result
+
+
+def _timed(func, *args, **kwargs):
+    # Runs on the render thread, so neither admission nor waiting for a thread is counted
+    started, busy_before = time.perf_counter(), _busy_now()
+    result = func(*args, **kwargs)
+    seconds, busy = time.perf_counter() - started, _busy_now() - busy_before
+    # Renders running alongside this one shared the CPUs with it: on average busy / seconds at once
+    contention = max(1.0, busy / seconds / CPU_COUNT) if seconds > 0 else 1.0
+    return result, seconds / contention
+
+
+async def run_timed_render(func, *args, template, **kwargs):
+    """
+    Like `run_render`, but also returns the render's run time.
+
+    Returns:
+        (result, seconds), seconds being the time the render would have taken
+        without other renders competing for the CPUs
+    """
+    async with memory.budget.reserve(memory.estimate(template)):
+        _add_running(1)
+        try:
+            # Like asyncio.to_thread, the render sees the caller's context variables
+            call = functools.partial(contextvars.copy_context().run, _timed, func, *args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(_render_pool, call)
+        finally:
+            _add_running(-1)
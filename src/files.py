@@ -0,0 +1,56 @@
+"""
+Async filesystem helpers for handlers.
+
+Even quick-looking file operations can stall on a busy or network-mounted
+cache volume, and everything that stalls on the event loop stalls every
+other command and the gateway heartbeat with it (see src/looplag.py). These
+run the blocking call in a worker thread instead, on asyncio's default
+executor (renders have their own pool, see src/dispatch.py).
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+
+import discord
+
+
+async def exists(path):
+    return await asyncio.to_thread(os.path.exists, path)
+
+
+async def getsize(path):
+    return await asyncio.to_thread(os.path.getsize, path)
+
+
+def _remove(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+async def remove(path):
+    """Remove a file, if it exists."""
+    await asyncio.to_thread(_remove, path)
+
+
+def _read(source):
+    if hasattr(source, 'read'):
+        with source:
+            return source.read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+async def discord_file(source, filename=None):
+    """
+    A discord.File that doesn't read from disk on the event loop.
+
+    Args:
+        source: Path, or an open binary file (which gets closed)
+        filename: Name to upload as, defaults to the file's name
+    """
+    if filename is None:
+        filename = os.path.basename(source if isinstance(source, (str, os.PathLike)) else source.name)
+    data = await asyncio.to_thread(_read, source)
+    return discord.File(io.BytesIO(data), filename=filename)
@@ -0,0 +1,66 @@
+"""
+Output formats.
+
+Renders can be encoded as GIF (palette quantization + gifsicle, the classic)
+or animated WebP, which Discord also plays inline and which skips both the
+quantization and the gifsicle pass. The format is picked per command (the
+`format` option), per guild (GUILD_OUTPUT_FORMATS) or globally (OUTPUT_FORMAT).
+"""
+
+from dataclasses import dataclass
+import os
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """
+    Attributes:
+        name: Format name used in config and command options
+        ext: File extension
+        lossless: WebP only, lossless encoding
+        quality: WebP only, 0-100 (for lossless: compression effort)
+    """
+    name: str
+    ext: str
+    lossless: bool = False
+    quality: int = 80
+
+    @property
+    def cache_suffix(self):
+        """Suffix telling this format's cache entries apart from others sharing its extension."""
+        return '_lossless' if self.lossless else ''
+
+
+FORMATS = {
+    'gif': OutputFormat('gif', 'gif'),
+    'webp': OutputFormat('webp', 'webp', quality=int(os.getenv('WEBP_QUALITY', '80'))),
+    'webp-lossless': OutputFormat('webp-lossless', 'webp', lossless=True, quality=int(os.getenv('WEBP_LOSSLESS_EFFORT', '50'))),
+}
+
+DEFAULT_FORMAT = os.getenv('OUTPUT_FORMAT', 'gif')
+
+
+def _parse_guild_formats(value):
+    """"123:webp,456:gif" -> {123: 'webp', 456: 'gif'}"""
+    guild_formats = {}
+    for item in value.split(','):
+        if ':' in item:
+            guild_id, name = item.split(':', 1)
+            guild_formats[int(guild_id.strip())] = name.strip()
+    return guild_formats
+
+
+GUILD_FORMATS = _parse_guild_formats(os.getenv('GUILD_OUTPUT_FORMATS', ''))
+
+
+def get_format(name):
+    """OutputFormat by name (falls back to GIF for unknown names)."""
+    return FORMATS.get(name, FORMATS['gif'])
+
+
+def select_format(interaction, requested=None):
+    """Output format for a command: explicit option, then the guild's setting, then the global default."""
+    if requested:
+        return get_format(requested)
+    guild_id = getattr(interaction, 'guild_id', None)
+    return get_format(GUILD_FORMATS.get(guild_id, DEFAULT_FORMAT))
@@ -0,0 +1,323 @@
+"""
+Golden-output equivalence harness.
+
+Renders a fixed corpus of avatars through the boiler, framemog and petter
+renderers and compares the results against golden outputs recorded earlier,
+frame by frame. Outputs are compared by what they look like when played,
+not byte for byte: both files are decoded, lined up on their timelines
+(encoders may merge or split identical frames) and every displayed frame is
+scored with SSIM and PSNR. Render time and output size are reported next to
+the quality numbers.
+
+    python -m src.golden record        # on the known good version
+    python -m src.golden check         # after changing the render path
+
+The built-in corpus is generated (flat, gradient, noisy and animated
+avatars), so it is the same everywhere; `--corpus DIR` adds real avatar
+images on top. Goldens live in GOLDEN_DIR (default cache/golden).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageSequence
+
+from src import avatars, formats
+from src.commands.boiler import replace_green_square_in_gif
+from src.commands.framemog import replace_color_squares_in_gif
+from src.commands.petter import generate_petpet_gif
+
+
+GOLDEN_DIR = Path(os.getenv('GOLDEN_DIR', 'cache/golden'))
+TEMPLATE_DIR = Path('templates')
+
+# A frame passes if it reaches either threshold
+MIN_SSIM = float(os.getenv('GOLDEN_MIN_SSIM', '0.97'))
+MIN_PSNR = float(os.getenv('GOLDEN_MIN_PSNR', '35'))
+# Allowed difference in total play time (ms)
+TIMING_TOLERANCE = 20
+
+AVATAR_SIZE = 256
+SSIM_WINDOW = 7
+
+
+def _corpus_flat(draw, size):
+    draw.rectangle([0, 0, size, size], fill=(88, 101, 242))
+    draw.ellipse([size // 4, size // 4, size * 3 // 4, size * 3 // 4], fill=(255, 255, 255))
+
+
+def _corpus_gradient(draw, size):
+    for y in range(size):
+        draw.line([0, y, size, y], fill=(y * 255 // size, 128, 255 - y * 255 // size))
+
+
+def make_corpus(directory):
+    """Write the built-in avatar corpus to `directory`. Returns {name: path}."""
+    directory.mkdir(parents=True, exist_ok=True)
+    corpus = {}
+
+    for name, paint in (('flat', _corpus_flat), ('gradient', _corpus_gradient)):
+        image = Image.new('RGB', (AVATAR_SIZE, AVATAR_SIZE))
+        paint(ImageDraw.Draw(image), AVATAR_SIZE)
+        corpus[name] = directory / f'{name}.png'
+        image.save(corpus[name])
+
+    # Compression-hostile detail
+    rng = np.random.default_rng(1234)
+    noise = rng.integers(0, 256, (AVATAR_SIZE, AVATAR_SIZE, 3), dtype=np.uint8)
+    corpus['noise'] = directory / 'noise.png'
+    Image.fromarray(noise).save(corpus['noise'])
+
+    # Animated avatar (a_ key), with a timeline that doesn't line up with the templates'
+    frames = []
+    for i in range(6):
+        frame = Image.new('RGB', (AVATAR_SIZE, AVATAR_SIZE), (30, 30, 30))
+        x = i * AVATAR_SIZE // 6
+        ImageDraw.Draw(frame).ellipse([x, 64, x + 96, 160], fill=(255, 200 - i * 30, 60))
+        frames.append(frame)
+    corpus['a_animated'] = directory / 'a_animated.gif'
+    frames[0].save(corpus['a_animated'], save_all=True, append_images=frames[1:], duration=70, loop=0)
+
+    return corpus
+
+
+def _open_avatar(path):
+    if path.name.startswith('a_'):
+        return avatars.AnimatedAvatar(path.read_bytes())
+    return Image.open(path).convert('RGBA')
+
+
+def cases(corpus, frame_workers=1):
+    """Render cases: name -> function(output_path, output_format, tier)."""
+    names = sorted(corpus)
+    result = {}
+    for index, name in enumerate(names):
+        avatar = corpus[name]
+        other = corpus[names[(index + 1) % len(names)]]
+
+        result[f'boiler_{name}'] = lambda out, fmt, tier, avatar=avatar: replace_green_square_in_gif(
+            TEMPLATE_DIR / 'boiler_template.gif', _open_avatar(avatar), out, tier=tier, output_format=fmt,
+            frame_workers=frame_workers,
+        )
+        result[f'framemog_{name}'] = lambda out, fmt, tier, avatar=avatar, other=other: replace_color_squares_in_gif(
+            TEMPLATE_DIR / 'framemog_template.gif', _open_avatar(other), _open_avatar(avatar), out,
+            tier=tier, output_format=fmt, frame_workers=frame_workers,
+        )
+        if not name.startswith('a_'):
+            # The petter has a fixed output format and no tiers
+            result[f'petter_{name}'] = lambda out, fmt, tier, avatar=avatar: generate_petpet_gif(avatar, out)
+    return result
+
+
+def durations(path):
+    """Per-frame durations (ms) of an animation."""
+    result = []
+    with Image.open(path) as image:
+        for frame in ImageSequence.Iterator(image):
+            # WebP only fills in a frame's duration once it is loaded
+            frame.load()
+            result.append(frame.info.get('duration', 100))
+    return result
+
+
+def frames_at(path, times):
+    """Yield the RGB frame (as an array) on screen at each of the sorted `times` (ms)."""
+    with Image.open(path) as image:
+        frames = ImageSequence.Iterator(image)
+        current, end = None, 0
+        for t in times:
+            while t >= end:
+                try:
+                    frame = next(frames)
+                except StopIteration:
+                    # Past the end of a shorter file: keep showing its last frame
+                    end = math.inf
+                    break
+                current = np.asarray(frame.convert('RGB'))
+                end += frame.info.get('duration', 100)
+            yield current
+
+
+def _box_mean(a, window):
+    """Mean over every window x window patch (valid positions only)."""
+    c = np.pad(a.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    total = c[window:, window:] - c[:-window, window:] - c[window:, :-window] + c[:-window, :-window]
+    return total / (window * window)
+
+
+def ssim(a, b):
+    """Mean SSIM of two RGB frames, computed on luma with a uniform window."""
+    weights = np.array([0.299, 0.587, 0.114])
+    x = a.astype(np.float64) @ weights
+    y = b.astype(np.float64) @ weights
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+
+    mu_x, mu_y = _box_mean(x, SSIM_WINDOW), _box_mean(y, SSIM_WINDOW)
+    var_x = _box_mean(x * x, SSIM_WINDOW) - mu_x ** 2
+    var_y = _box_mean(y * y, SSIM_WINDOW) - mu_y ** 2
+    cov = _box_mean(x * y, SSIM_WINDOW) - mu_x * mu_y
+
+    score = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(score.mean())
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def compare(golden_path, candidate_path):
+    """
+    Compare two animations as they play.
+
+    Returns:
+        dict with the worst frame's SSIM and PSNR, the number of failing
+        frames, and both total play times.
+    """
+    golden_durations, candidate_durations = durations(golden_path), durations(candidate_path)
+    golden_total, candidate_total = sum(golden_durations), sum(candidate_durations)
+
+    # Every point where either file switches frames; in between both show a fixed image
+    boundaries = set()
+    for frame_durations in (golden_durations, candidate_durations):
+        t = 0
+        for duration in frame_durations:
+            boundaries.add(t)
+            t += duration
+    times = sorted(t for t in boundaries if t < max(golden_total, candidate_total))
+
+    worst_ssim, worst_psnr, failing = 1.0, math.inf, 0
+    for golden, candidate in zip(frames_at(golden_path, times), frames_at(candidate_path, times)):
+        if golden.shape != candidate.shape:
+            return {'error': f'size {golden.shape[1::-1]} != {candidate.shape[1::-1]}'}
+        frame_ssim, frame_psnr = ssim(golden, candidate), psnr(golden, candidate)
+        worst_ssim, worst_psnr = min(worst_ssim, frame_ssim), min(worst_psnr, frame_psnr)
+        if frame_ssim < MIN_SSIM and frame_psnr < MIN_PSNR:
+            failing += 1
+
+    return {
+        'ssim': worst_ssim,
+        'psnr': worst_psnr,
+        'failing_frames': failing,
+        'golden_ms': golden_total,
+        'candidate_ms': candidate_total,
+    }
+
+
+def render(func, output_path, output_format, tier):
+    """Render one case. Returns {'seconds', 'size', 'frames'}."""
+    start = time.perf_counter()
+    # The petter prints progress; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(output_path, output_format, tier)
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'size': os.path.getsize(output_path),
+        'frames': len(durations(output_path)),
+    }
+
+
+def _selected(all_cases, only):
+    return {name: func for name, func in all_cases.items() if not only or any(o in name for o in only)}
+
+
+def record(args):
+    corpus = make_corpus(GOLDEN_DIR / 'corpus')
+    if args.corpus:
+        corpus.update({p.stem: p for p in sorted(Path(args.corpus).iterdir()) if p.suffix in ('.png', '.gif', '.jpg')})
+
+    output_format = formats.get_format(args.output_format)
+    manifest = {'tier': args.tier, 'format': output_format.name, 'corpus': {k: str(v) for k, v in corpus.items()}, 'cases': {}}
+    for name, func in _selected(cases(corpus, args.frame_workers), args.only).items():
+        ext = 'gif' if name.startswith('petter_') else output_format.ext
+        output_path = GOLDEN_DIR / f'{name}.{ext}'
+        manifest['cases'][name] = dict(render(func, output_path, output_format.name, args.tier), file=output_path.name)
+        print(f"  {name}: {manifest['cases'][name]['size'] / 1024:.0f} KiB in {manifest['cases'][name]['seconds']:.2f}s")
+
+    with open(GOLDEN_DIR / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Recorded {len(manifest['cases'])} goldens in {GOLDEN_DIR}")
+    return 0
+
+
+def check(args):
+    try:
+        with open(GOLDEN_DIR / 'manifest.json') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        print(f"No goldens in {GOLDEN_DIR}, run `python -m src.golden record` first")
+        return 2
+
+    corpus = {name: Path(path) for name, path in manifest['corpus'].items()}
+    output_format = formats.get_format(args.output_format or manifest['format'])
+    candidate_dir = GOLDEN_DIR / 'candidate'
+    candidate_dir.mkdir(exist_ok=True)
+
+    print(f"{'case':<24} {'ssim':>7} {'psnr':>7} {'timing':>8} {'time':>15} {'speedup':>8} {'size':>8}")
+    failures = 0
+    golden_seconds = candidate_seconds = 0
+    for name, func in _selected(cases(corpus, args.frame_workers), args.only).items():
+        golden = manifest['cases'].get(name)
+        if golden is None:
+            print(f"{name:<24} no golden")
+            continue
+
+        ext = 'gif' if name.startswith('petter_') else output_format.ext
+        candidate_path = candidate_dir / f'{name}.{ext}'
+        result = render(func, candidate_path, output_format.name, manifest['tier'])
+        scores = compare(GOLDEN_DIR / golden['file'], candidate_path)
+        if 'error' in scores:
+            failures += 1
+            print(f"{name:<24} FAIL: {scores['error']}")
+            continue
+
+        timing_ok = abs(scores['golden_ms'] - scores['candidate_ms']) <= TIMING_TOLERANCE
+        passed = timing_ok and scores['failing_frames'] == 0
+        failures += not passed
+        golden_seconds += golden['seconds']
+        candidate_seconds += result['seconds']
+
+        times = f"{golden['seconds']:.2f}s -> {result['seconds']:.2f}s"
+        print(
+            f"{name:<24} {scores['ssim']:>7.4f} {scores['psnr']:>7.1f} {'ok' if timing_ok else 'OFF':>8} "
+            f"{times:>15} {golden['seconds'] / result['seconds']:>7.2f}x "
+            f"{(result['size'] - golden['size']) / golden['size']:>+8.1%}"
+            + ('' if passed else f"  FAIL ({scores['failing_frames']} frames)")
+        )
+
+    if candidate_seconds:
+        print(f"\nOverall speedup: {golden_seconds / candidate_seconds:.2f}x")
+    print(f"{failures} case(s) failed" if failures else "All cases match their goldens")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.golden', description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=('record', 'check'))
+    parser.add_argument('--tier', type=int, default=100, help='Template tier to record at (check uses the recorded one)')
+    parser.add_argument('--format', dest='output_format', choices=list(formats.FORMATS),
+                        help='Output format (record: default gif, check: default the recorded one)')
+    parser.add_argument('--corpus', help='Directory of extra avatar images to record')
+    parser.add_argument('--only', nargs='*', help='Only cases whose name contains one of these')
+    parser.add_argument('--frame-workers', type=int, default=1,
+                        help='Frames to render in parallel (see pipeline.map_frames)')
+    args = parser.parse_args(argv)
+
+    GOLDEN_DIR.mkdir(parents=True, exist_ok=True)
+    if args.command == 'record':
+        args.output_format = args.output_format or 'gif'
+        return record(args)
+    return check(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+End-to-end load test.
+
+Replays synthetic traffic through the bot's real slash command handlers
+(`/boil`, `/framemog` and `/pet` in src/bot.py) with stand-ins for discord.py's
+Interaction, User and Asset: avatars are served from local files and
+followup sends are recorded (and held for a simulated upload time) instead
+of going to Discord. Unlike timing the renderers on their own, this includes
+queueing for the memory budget, event loop contention, the render and
+sprite caches and the upload.
+
+    python -m src.loadtest --rate 2 --duration 60
+    python -m src.loadtest --requests 300 --rate 5 --mix boil=5,framemog=4,pet=1 --burst-every 10 --burst-size 20
+
+Traffic:
+
+- a population of `--users` users, ranked by popularity; each request's
+  target is drawn from a Zipf distribution (`--zipf`), so a few users get
+  most of the requests
+- `--default-avatars` of the users have one of Discord's default avatars
+  (a handful of avatar keys shared by all of them), `--animated` have
+  animated (a_) avatars
+- requests arrive as a Poisson process at `--rate` per second, plus
+  `--burst-size` requests at once every `--burst-every` seconds
+
+The report has latency percentiles (command invoked -> done, including the
+upload), throughput, cache hit rate (renders answered without rendering),
+peak RSS and event loop lag. The run happens in a scratch directory
+(`--workdir`, a new temporary directory by default) so it starts with a cold
+cache and never touches the live one; point a second run at the same
+directory to measure a warm cache.
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import datetime
+import itertools
+import logging
+import os
+from pathlib import Path
+import random
+import tempfile
+import time
+
+from PIL import Image
+
+from src import golden, looplag, memory, render
+
+
+COMMANDS = ('boil', 'framemog', 'pet')
+# Discord's default avatars (embed/avatars/0.png ... 5.png) and their colors
+DEFAULT_AVATAR_COLORS = ((88, 101, 242), (117, 126, 138), (59, 165, 92), (250, 166, 26), (237, 66, 69), (235, 69, 158))
+GUILD_ID = 1
+MB = 1024 * 1024
+
+
+class FakeAsset:
+    """Stands in for discord.Asset, serving the avatar from a local file."""
+
+    def __init__(self, key, path):
+        self.key = key
+        self.path = Path(path)
+
+    @property
+    def url(self):
+        return self.path.as_uri()
+
+    def is_animated(self):
+        return self.key.startswith('a_')
+
+    def replace(self, **kwargs):
+        # Sizes and formats aren't negotiated: the file is served as it is
+        return self
+
+    async def read(self):
+        return await asyncio.to_thread(self.path.read_bytes)
+
+
+class FakeUser:
+    """Stands in for discord.User."""
+
+    def __init__(self, user_id, avatar):
+        self.id = user_id
+        self.name = self.display_name = self.global_name = f'user{user_id}'
+        self.mention = f'<@{user_id}>'
+        self.display_avatar = avatar
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name):
+        self.id = guild_id
+        self.name = name
+
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+
+@dataclass
+class Send:
+    """A recorded followup message."""
+    at: float
+    content: str
+    filename: str = None
+    size: int = 0
+
+
+class FakeFollowup:
+    """Records sends; files take `size / upload_bps` seconds to "upload"."""
+
+    def __init__(self, upload_bps):
+        self.upload_bps = upload_bps
+        self.sends = []
+
+    async def send(self, content=None, file=None, **kwargs):
+        filename, size = None, 0
+        if file is not None:
+            filename, size = file.filename, len(file.fp.read())
+            if self.upload_bps:
+                await asyncio.sleep(size / self.upload_bps)
+        self.sends.append(Send(time.perf_counter(), content, filename, size))
+
+
+class FakeInteraction:
+    """Stands in for discord.Interaction, as far as the command handlers use it."""
+
+    def __init__(self, user, guild, filesize_limit, upload_bps):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel_id = guild.id
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.filesize_limit = filesize_limit
+        self.response = FakeResponse()
+        self.followup = FakeFollowup(upload_bps)
+
+
+@dataclass
+class Result:
+    command: str
+    latency: float
+    sends: list = field(default_factory=list)
+    error: str = None
+
+    @property
+    def failed(self):
+        return self.error is not None or not any(send.filename for send in self.sends)
+
+    @property
+    def cache_hit(self):
+        """Whether a render command was answered from the cache (None for /pet and failures)."""
+        if self.command == 'pet' or self.failed:
+            return None
+        # Fresh renders are sent as output_<ids>.<ext>, cached ones under their cache name
+        return not any(send.filename and send.filename.startswith('output_') for send in self.sends)
+
+
+def make_avatars(directory, avatar_dir=None):
+    """
+    Avatar images for the population.
+
+    Returns:
+        (static image paths, animated image paths, default avatar paths)
+    """
+    if avatar_dir is not None:
+        paths = sorted(path for path in Path(avatar_dir).iterdir() if path.suffix.lower() in render.IMAGE_SUFFIXES)
+    else:
+        paths = sorted(golden.make_corpus(directory / 'corpus').values())
+
+    static, animated = [], []
+    for path in paths:
+        with Image.open(path) as image:
+            (animated if getattr(image, 'n_frames', 1) > 1 else static).append(path)
+
+    defaults = []
+    for index, color in enumerate(DEFAULT_AVATAR_COLORS):
+        path = directory / 'defaults' / f'{index}.png'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', (256, 256), color).save(path)
+        defaults.append(path)
+
+    return static, animated or static, defaults
+
+
+def make_users(count, avatar_images, default_fraction, animated_fraction, rng):
+    """`count` users, most popular first."""
+    static, animated, defaults = avatar_images
+    users = []
+    for rank in range(count):
+        user_id = 100000 + rank
+        roll = rng.random()
+        if roll < default_fraction:
+            index = rng.randrange(len(defaults))
+            avatar = FakeAsset(str(index), defaults[index])
+        elif roll < default_fraction + animated_fraction:
+            avatar = FakeAsset(f'a_{rng.getrandbits(64):016x}', rng.choice(animated))
+        else:
+            avatar = FakeAsset(f'{rng.getrandbits(64):016x}', rng.choice(static))
+        users.append(FakeUser(user_id, avatar))
+    return users
+
+
+def schedule(args, rng):
+    """Request start times (seconds from the start) with their commands, in order."""
+    commands, weights = zip(*args.mix.items())
+    times = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(args.rate)
+        if (args.duration is not None and t > args.duration) or (args.requests is not None and len(times) >= args.requests):
+            break
+        times.append(t)
+    if args.burst_every:
+        end = times[-1] if times else 0.0
+        times += [
+            burst * args.burst_every
+            for burst in range(1, int(end // args.burst_every) + 1)
+            for _ in range(args.burst_size)
+        ]
+    return [(t, rng.choices(commands, weights)[0]) for t in sorted(times)]
+
+
+async def invoke(bot, command, interaction, target):
+    """Run one command handler the way discord.py would. Returns a Result."""
+    started = time.perf_counter()
+    error = None
+    try:
+        if command == 'boil':
+            await bot.boil.callback(interaction, target, None)
+        elif command == 'framemog':
+            await bot.framemog.callback(interaction, target, None, None)
+        else:
+            await bot.pet.callback(interaction)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    result = Result(command, time.perf_counter() - started, interaction.followup.sends, error)
+    if error is None and result.failed:
+        result.error = next((send.content for send in result.sends if send.content), 'nothing sent')
+    return result
+
+
+async def _sample_memory(peak, interval=0.05):
+    while True:
+        peak[0] = max(peak[0], memory.current_rss())
+        await asyncio.sleep(interval)
+
+
+async def run(args):
+    from src import bot, templates
+
+    rng = random.Random(args.seed)
+    users = make_users(
+        args.users, make_avatars(Path.cwd() / 'loadtest', args.avatars), args.default_avatars, args.animated, rng
+    )
+    # Zipf popularity over the users' ranks
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** args.zipf for rank in range(len(users))))
+    guild = FakeGuild(GUILD_ID, 'Load Test')
+    filesize_limit = int(args.limit_mb * MB)
+    upload_bps = args.upload_mbps * MB
+
+    looplag.start()
+    # Like on_ready: compile the template tiers before traffic arrives
+    await asyncio.to_thread(templates.compile_all, [bot.BOILER_TEMPLATE, bot.FRAMEMOG_TEMPLATE])
+
+    plan = schedule(args, rng)
+    print(f"Replaying {len(plan)} requests over {plan[-1][0] if plan else 0:.0f}s against {len(users)} users")
+
+    baseline_rss = memory.current_rss()
+    peak_rss = [baseline_rss]
+    sampler = asyncio.create_task(_sample_memory(peak_rss))
+    started = time.perf_counter()
+
+    tasks = []
+    for at, command in plan:
+        delay = started + at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        requester = rng.choice(users)
+        target = rng.choices(users, cum_weights=cum_weights)[0]
+        interaction = FakeInteraction(requester, guild, filesize_limit, upload_bps)
+        tasks.append(asyncio.create_task(invoke(bot, command, interaction, target)))
+
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+
+    report(results, elapsed, baseline_rss, peak_rss[0])
+
+
+def _percentile(ordered, p):
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+def report(results, elapsed, baseline_rss, peak_rss):
+    print(f"\n{'command':<10} {'requests':>8} {'errors':>7} {'hit rate':>9} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for command in (*COMMANDS, None):
+        selected = [r for r in results if command is None or r.command == command]
+        if not selected:
+            continue
+        latencies = sorted(r.latency for r in selected)
+        hits = [r.cache_hit for r in selected if r.cache_hit is not None]
+        hit_rate = f'{sum(hits) / len(hits):.0%}' if hits else '-'
+        percentiles = ' '.join(f'{_percentile(latencies, p):>7.2f}s' for p in (0.50, 0.95, 0.99))
+        print(
+            f"{command or 'all':<10} {len(selected):>8} {sum(r.failed for r in selected):>7} {hit_rate:>9} {percentiles}"
+        )
+
+    sent = sum(send.size for r in results for send in r.sends)
+    print(f"\nThroughput: {len(results) / elapsed:.2f} requests/s, {sent / MB / elapsed:.2f} MB/s sent ({elapsed:.1f}s)")
+    print(f"Peak RSS: {peak_rss / MB:.0f} MB ({(peak_rss - baseline_rss) / MB:+.0f} MB over the start)")
+    lag = looplag.summary()
+    if lag['samples']:
+        print(f"Event loop lag: p50 {lag['p50_ms']:.0f} ms, p99 {lag['p99_ms']:.0f} ms, max {lag['max_ms']:.0f} ms")
+
+    errors = {}
+    for r in results:
+        if r.failed:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    for error, count in sorted(errors.items(), key=lambda item: -item[1]):
+        print(f"  {count}x {error}")
+
+
+def _parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        command, _, weight = item.partition('=')
+        if command.strip() not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {command.strip()!r} (choose from {', '.join(COMMANDS)})")
+        mix[command.strip()] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.loadtest', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=1.0, help='Mean requests per second')
+    parser.add_argument('--duration', type=float, help='Seconds of traffic (default 60 unless --requests is given)')
+    parser.add_argument('--requests', type=int, help='Number of requests (not counting bursts)')
+    parser.add_argument('--mix', type=_parse_mix, default='boil=6,framemog=3,pet=1',
+                        help='Command weights, e.g. boil=6,framemog=3,pet=1')
+    parser.add_argument('--users', type=int, default=200, help='Population size')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of target popularity (0 = uniform)')
+    parser.add_argument('--default-avatars', type=float, default=0.2, help='Fraction of users with a default avatar')
+    parser.add_argument('--animated', type=float, default=0.1, help='Fraction of users with an animated avatar')
+    parser.add_argument('--burst-every', type=float, help='Seconds between bursts')
+    parser.add_argument('--burst-size', type=int, default=10, help='Requests per burst')
+    parser.add_argument('--limit-mb', type=float, default=10, help='Upload limit of the fake channel')
+    parser.add_argument('--upload-mbps', type=float, default=10, help='Simulated upload speed in MB/s (0 = instant)')
+    parser.add_argument('--avatars', help='Directory of avatar images to use instead of the built-in corpus')
+    parser.add_argument('--workdir', help='Directory to run in (cache, temp files); default: a new temporary one')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's logs")
+    args = parser.parse_args(argv)
+    if args.duration is None and args.requests is None:
+        args.duration = 60.0
+
+    # Templates from this checkout unless configured otherwise; paths are fixed when src.bot is imported
+    os.environ.setdefault('TEMPLATE_DIR', str(golden.TEMPLATE_DIR.resolve()))
+    if args.avatars is not None:
+        args.avatars = Path(args.avatars).resolve()
+    from src import bot  # noqa: F401
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='brainrotter-loadtest-')).resolve()
+    for directory in ('cache/boiler', 'cache/framemog', 'temp'):
+        (workdir / directory).mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+    print(f"Working directory: {workdir}")
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
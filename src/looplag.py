@@ -0,0 +1,159 @@
+"""
+Event loop lag monitoring.
+
+Anything that blocks the event loop (file I/O, image work that slipped out of
+a worker thread, ...) delays every other handler and the gateway heartbeat.
+Two things are measured:
+
+- lag: a sampler task sleeps LOOP_LAG_INTERVAL seconds at a time and records
+  how much later than scheduled it wakes up
+- slow steps: every task's coroutine is wrapped (via the loop's task factory)
+  so each step it runs between two awaits is timed, and attributed to the
+  handler that created the task (see `handler`)
+
+Lag above LOOP_LAG_WARN_MS is logged together with the slowest step since
+the previous sample, which is almost always the culprit. `summary()` exports
+recent lag percentiles.
+"""
+
+import asyncio
+from collections import deque
+import collections.abc
+import contextvars
+import functools
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.1'))
+LOOP_LAG_WARN_MS = float(os.getenv('LOOP_LAG_WARN_MS', '100'))
+# Steps shorter than this aren't worth remembering
+SLOW_STEP_MS = float(os.getenv('LOOP_SLOW_STEP_MS', '20'))
+
+# Name of the handler the current task works for
+current_handler = contextvars.ContextVar('current_handler', default=None)
+
+# Recent lag samples in seconds
+samples = deque(maxlen=int(os.getenv('LOOP_LAG_SAMPLES', '3000')))
+# Slowest step since the last lag sample: (seconds, handler, coroutine name)
+_slowest_step = None
+_monitor_task = None
+
+
+def handler(func):
+    """Attribute everything `func` (an async handler) runs on the loop, including tasks it starts, to it."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = current_handler.set(func.__name__)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            current_handler.reset(token)
+    return wrapper
+
+
+def _record_step(coro, seconds):
+    global _slowest_step
+    if seconds * 1000 < SLOW_STEP_MS:
+        return
+    if _slowest_step is None or seconds > _slowest_step[0]:
+        name = getattr(coro, '__qualname__', None) or type(coro).__name__
+        _slowest_step = (seconds, current_handler.get(), name)
+
+
+class _TimedCoroutine(collections.abc.Coroutine):
+    """Coroutine wrapper timing each step (send/throw) of the wrapped coroutine."""
+
+    def __init__(self, coro):
+        self._coro = coro
+        self.__qualname__ = getattr(coro, '__qualname__', type(coro).__name__)
+        self.__name__ = getattr(coro, '__name__', self.__qualname__)
+
+    def send(self, value):
+        start = time.perf_counter()
+        try:
+            return self._coro.send(value)
+        finally:
+            _record_step(self._coro, time.perf_counter() - start)
+
+    def throw(self, *args):
+        start = time.perf_counter()
+        try:
+            return self._coro.throw(*args)
+        finally:
+            _record_step(self._coro, time.perf_counter() - start)
+
+    def close(self):
+        return self._coro.close()
+
+    def __next__(self):
+        return self.send(None)
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    @property
+    def cr_frame(self):
+        return getattr(self._coro, 'cr_frame', None)
+
+    @property
+    def cr_running(self):
+        return getattr(self._coro, 'cr_running', False)
+
+    def __repr__(self):
+        return repr(self._coro)
+
+
+def _task_factory(loop, coro, **kwargs):
+    return asyncio.Task(_TimedCoroutine(coro), loop=loop, **kwargs)
+
+
+async def _monitor(interval):
+    global _slowest_step
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - start - interval, 0.0)
+        samples.append(lag)
+
+        if lag * 1000 >= LOOP_LAG_WARN_MS:
+            if _slowest_step is not None:
+                seconds, handler_name, name = _slowest_step
+                culprit = f"slowest step: {name} ({seconds * 1000:.0f} ms) in {handler_name or 'no handler'}"
+            else:
+                culprit = "no slow task step seen (blocking callback?)"
+            logger.warning(f"Event loop lag {lag * 1000:.0f} ms, {culprit}")
+        _slowest_step = None
+
+
+def start(interval=LOOP_LAG_INTERVAL):
+    """Install the step timer on the running loop and start sampling lag (once)."""
+    global _monitor_task
+    if _monitor_task is not None and not _monitor_task.done():
+        return
+    asyncio.get_running_loop().set_task_factory(_task_factory)
+    _monitor_task = asyncio.create_task(_monitor(interval), name='looplag')
+
+
+def summary():
+    """Lag percentiles (ms) over the recent samples."""
+    if not samples:
+        return {'samples': 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)] * 1000
+
+    return {
+        'samples': len(ordered),
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+        'max_ms': ordered[-1] * 1000,
+    }
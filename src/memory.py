@@ -0,0 +1,198 @@
+"""
+Per-render memory accounting and the global render memory budget.
+
+Every render runs inside `track_render`, which records its peak memory
+together with the template, avatar dimensions and frame count:
+
+- with MEMORY_DEBUG=1, tracemalloc snapshots are taken around the render and
+  the top allocation sites are logged as well (slow, for debugging)
+- otherwise a background thread samples the process RSS while the render runs
+
+Both are process-wide measurements, so with several renders in flight the
+numbers include some of their neighbours' memory too.
+
+Peaks are remembered per template and used as the estimate when the
+dispatcher asks `budget` to admit a new render. With MEMORY_BUDGET_MB set,
+renders that would push the total over budget wait instead of running.
+"""
+
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+import logging
+import os
+from pathlib import Path
+import resource
+import threading
+import time
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+
+MEMORY_DEBUG = os.getenv('MEMORY_DEBUG', '0') == '1'
+# Process-wide memory the bot may use before renders start queueing, 0 disables the budget
+MEMORY_BUDGET_MB = float(os.getenv('MEMORY_BUDGET_MB', '0'))
+# Used until a template has rendered at least once
+DEFAULT_RENDER_ESTIMATE_MB = float(os.getenv('DEFAULT_RENDER_ESTIMATE_MB', '64'))
+
+RSS_SAMPLE_INTERVAL = 0.01
+MB = 1024 * 1024
+
+# template name -> largest recent peak (bytes)
+peak_history = {}
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # No procfs: fall back to the lifetime peak, which is at least an upper bound
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _RssSampler(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.baseline = current_rss()
+        self.peak = self.baseline
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak - self.baseline
+
+
+@dataclass
+class RenderStats:
+    """Memory/timing record of one render."""
+    name: str
+    template: str
+    avatar_sizes: list = field(default_factory=list)
+    frames: int = 0
+    peak_bytes: int = 0
+    seconds: float = 0.0
+
+
+def template_name(template_path):
+    return Path(template_path).stem
+
+
+@contextlib.contextmanager
+def track_render(name, template_path):
+    """
+    Measure the peak memory of the render running inside this block.
+
+    The renderer fills in `avatar_sizes` and `frames` on the yielded RenderStats.
+    """
+    stats = RenderStats(name=name, template=template_name(template_path))
+    started = time.perf_counter()
+
+    if MEMORY_DEBUG:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        before = tracemalloc.take_snapshot()
+    else:
+        sampler = _RssSampler()
+        sampler.start()
+
+    try:
+        yield stats
+    finally:
+        stats.seconds = time.perf_counter() - started
+
+        if MEMORY_DEBUG:
+            _, peak = tracemalloc.get_traced_memory()
+            stats.peak_bytes = peak - baseline
+            top = tracemalloc.take_snapshot().compare_to(before, 'lineno')[:5]
+        else:
+            stats.peak_bytes = sampler.stop()
+            top = []
+
+        record(stats)
+        logger.info(
+            f"Render memory: {stats.name} template={stats.template} "
+            f"avatar={','.join('x'.join(map(str, size)) for size in stats.avatar_sizes) or '-'} "
+            f"frames={stats.frames} peak={stats.peak_bytes / MB:.1f} MB "
+            f"rss={current_rss() / MB:.1f} MB time={stats.seconds:.2f}s"
+        )
+        for line in top:
+            logger.info(f"  {line}")
+
+
+def record(stats):
+    """Remember a render's peak for future estimates (decaying, so one outlier doesn't stick forever)."""
+    previous = peak_history.get(stats.template, 0)
+    peak_history[stats.template] = max(stats.peak_bytes, int(previous * 0.9))
+
+
+def estimate(template_path):
+    """Expected peak memory (bytes) of a render of this template."""
+    return peak_history.get(template_name(template_path)) or int(DEFAULT_RENDER_ESTIMATE_MB * MB)
+
+
+class MemoryBudget:
+    """
+    Admission control for renders.
+
+    Each render reserves its estimated peak before it starts and gives it back
+    when done. A render is admitted while both the reservations and the current
+    process RSS leave room for it under the limit; otherwise it waits. A render
+    bigger than the whole budget still runs, but only on its own.
+    """
+
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.reserved = 0
+        self.waiting = 0
+        self._condition = None
+
+    def _fits(self, nbytes):
+        if self.reserved == 0:
+            return True
+        return self.reserved + nbytes <= self.limit and current_rss() + nbytes <= self.limit
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes):
+        if not self.limit:
+            yield
+            return
+
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            if not self._fits(nbytes):
+                logger.info(
+                    f"Render queued: needs ~{nbytes / MB:.0f} MB, "
+                    f"{self.reserved / MB:.0f}/{self.limit / MB:.0f} MB reserved"
+                )
+            self.waiting += 1
+            try:
+                while not self._fits(nbytes):
+                    # RSS can drop without anyone notifying us, so re-check now and then
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._condition.wait(), timeout=0.5)
+            finally:
+                self.waiting -= 1
+            self.reserved += nbytes
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.reserved -= nbytes
+                self._condition.notify_all()
+
+
+budget = MemoryBudget(int(MEMORY_BUDGET_MB * MB))
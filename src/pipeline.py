@@ -0,0 +1,394 @@
+"""
+Frame pipeline shared by the renderers.
+
+A render is a chain of generators:
+
+    decode_frames -> (renderer's composite step) -> [decimate] -> quantize_frames -> write_gif
+    decode_frames -> (renderer's composite step) -> [decimate] -> write_webp
+
+(`encode` picks the tail for an output format.) Every stage passes frames on
+as soon as they are ready and the encoders consume them immediately, so a
+render holds a couple of frames in memory at a time regardless of how long
+the template is.
+
+The per-frame work (compositing, RGB conversion, diffing and quantizing) can
+be spread over a thread pool shared by all renders (see `map_frames`); NumPy
+and Pillow release the GIL for it. Frames still reach the encoder in order,
+and only a window of `workers` frames is in flight at a time.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+import os
+import shutil
+import subprocess
+import threading
+
+import numpy as np
+import PIL
+from PIL import GifImagePlugin, Image, ImageFilter, ImageSequence, WebPImagePlugin
+from PIL.Image import Palette
+
+
+# Size of the frame pool shared by all renders
+FRAME_THREADS = int(os.getenv('FRAME_THREADS', str(os.process_cpu_count() or 1)))
+
+_frame_pool = None
+_frame_pool_lock = threading.Lock()
+
+# Pillow major versions whose private WebP animation encoder write_webp knows
+# how to drive (argument order taken from WebPImagePlugin._save_all in Pillow
+# 12.1.1, the pinned version, and unchanged through 12.3.0); anything else
+# uses Pillow's public writer instead
+STREAMING_WEBP_PILLOW = (12,)
+
+
+def _pool():
+    global _frame_pool
+    with _frame_pool_lock:
+        if _frame_pool is None:
+            _frame_pool = ThreadPoolExecutor(max_workers=FRAME_THREADS, thread_name_prefix='frames')
+        return _frame_pool
+
+
+def map_frames(func, items, workers=1):
+    """
+    Yield `func(item)` for each of `items`, in order, computed on the shared frame pool.
+
+    At most `workers` items are in flight at once (a sliding window), so this
+    holds a bounded number of frames however long the template is. `workers`
+    may be a callable, checked again for every item, so a render that started
+    on an idle bot backs off when others start. With one worker everything
+    runs inline.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            count = max(workers() if callable(workers) else workers, 1)
+            if count == 1:
+                while pending:
+                    yield pending.popleft().result()
+                yield func(item)
+                continue
+
+            pending.append(_pool().submit(func, item))
+            while len(pending) >= count:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def decode_frames(template_path, frame_plan=None):
+    """
+    Yield (RGBA frame, duration) for every frame of a template, one at a time.
+
+    With a frame plan (see templates.TemplateInfo.frame_plan), only the first
+    frame of each run is yielded, for the run's combined duration.
+    """
+    with Image.open(template_path) as template:
+        if frame_plan is None:
+            for frame in ImageSequence.Iterator(template):
+                yield frame.convert('RGBA'), frame.info.get('duration', 100)
+            return
+
+        run_lengths = dict(frame_plan)
+        kept = None
+        remaining = 0
+        for index, frame in enumerate(ImageSequence.Iterator(template)):
+            duration = frame.info.get('duration', 100)
+            if remaining == 0:
+                kept = [frame.convert('RGBA'), duration]
+                remaining = run_lengths[index]
+            else:
+                kept[1] += duration
+            remaining -= 1
+            if remaining == 0:
+                yield tuple(kept)
+
+
+def scale_sprite(insert_original, size, blur_radius):
+    """Resize (and blur) `insert_original` to a slot size."""
+    resized = insert_original.resize(size, Image.Resampling.LANCZOS)
+
+    # Slight blur to reduce compression-hostile detail from the insert image
+    if blur_radius and blur_radius > 0:
+        resized = resized.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+
+    return resized
+
+
+def paste_sprite(frame, sprite, pos):
+    """Paste an already scaled sprite (see `scale_sprite`) onto a copy of `frame`."""
+    result = frame.copy()
+    result.paste(sprite, pos, sprite)
+    return result
+
+
+def decimate(frames, step):
+    """Keep every `step`-th (frame, duration), folding the dropped frames' durations into the kept ones."""
+    if step <= 1:
+        yield from frames
+        return
+
+    kept = None
+    for index, (frame, duration) in enumerate(frames):
+        if index % step == 0:
+            if kept is not None:
+                yield tuple(kept)
+            kept = [frame, duration]
+        else:
+            kept[1] += duration
+    if kept is not None:
+        yield tuple(kept)
+
+
+def _changed_box(previous, current):
+    """Bounding box (left, top, right, bottom) of pixels that differ, or None if identical."""
+    changed = np.any(previous != current, axis=2)
+    rows = np.any(changed, axis=1)
+    if not rows.any():
+        return None
+    cols = np.any(changed, axis=0)
+    y_min, y_max = np.where(rows)[0][[0, -1]]
+    x_min, x_max = np.where(cols)[0][[0, -1]]
+    return int(x_min), int(y_min), int(x_max) + 1, int(y_max) + 1
+
+
+def _to_rgb(item):
+    frame, duration = item
+    return frame.convert('RGB'), duration
+
+
+def _to_rgb_array(item):
+    rgb, duration = _to_rgb(item)
+    return rgb, np.asarray(rgb), duration
+
+
+def _quantize_frame(item, colors, keep_unchanged, palette):
+    previous, (rgb, current, duration) = item
+    if previous is None:
+        box = (0, 0) + rgb.size
+    else:
+        box = _changed_box(previous, current)
+        if box is None and keep_unchanged:
+            box = (0, 0, 1, 1)
+
+    if box is None:
+        return None, None, duration
+
+    region = rgb if box == (0, 0) + rgb.size else rgb.crop(box)
+    if palette is not None:
+        return region.quantize(palette=palette, dither=Image.Dither.NONE), box[:2], duration
+    return region.convert('P', palette=Palette.ADAPTIVE, colors=colors), box[:2], duration
+
+
+def quantize_frames(frames, colors, keep_unchanged=False, workers=1, palette=None):
+    """
+    Turn composited (frame, duration) pairs into palette frames ready to encode.
+
+    Only the part of each frame that changed since the previous one is
+    quantized, so the encoder can write it as a small sub-image on top of the
+    previous frame.
+
+    Args:
+        frames: Iterable of (frame, duration)
+        colors: Number of colors in the palette
+        keep_unchanged: Emit a 1x1 update for frames identical to the previous
+            one instead of letting the encoder merge them, so the output keeps
+            exactly one frame per input frame
+        workers: Frames to convert and quantize in parallel (see `map_frames`)
+        palette: P-mode image whose palette every frame is mapped to (without
+            dithering, so pixels that don't change keep their index), instead
+            of an adaptive palette per frame
+
+    Yields:
+        (P-mode image, (x, y) offset, duration). The image is None when the
+        frame is identical to the previous one.
+    """
+    def with_previous(converted):
+        previous = None
+        for rgb, current, duration in converted:
+            yield previous, (rgb, current, duration)
+            previous = current
+
+    quantize = functools.partial(_quantize_frame, colors=colors, keep_unchanged=keep_unchanged, palette=palette)
+    yield from map_frames(quantize, with_previous(map_frames(_to_rgb_array, frames, workers)), workers)
+
+
+def write_gif(frames, output_path, loop=0):
+    """
+    Stream quantized frames (see `quantize_frames`) into a GIF file.
+
+    One frame is held back so that unchanged frames can be folded into its
+    duration; everything else is written as soon as it arrives. Frames use
+    disposal 1 (keep), since each one only covers what changed.
+
+    Returns:
+        Number of frames written.
+    """
+    written = 0
+    pending = None
+
+    with open(output_path, 'wb') as fp:
+        def write(image, offset, duration):
+            for chunk in GifImagePlugin.getdata(
+                    image, offset, duration=duration, disposal=1, include_color_table=True
+            ):
+                fp.write(chunk)
+
+        for image, offset, duration in frames:
+            if image is None:
+                if pending is not None:
+                    pending[2] += duration
+                continue
+
+            if pending is None:
+                # The first frame always covers the whole canvas; it sets up the header
+                header, _ = GifImagePlugin.getheader(image, info={'loop': loop})
+                for chunk in header:
+                    fp.write(chunk)
+            else:
+                write(*pending)
+                written += 1
+            pending = [image, offset, duration]
+
+        if pending is None:
+            raise ValueError("No frames to write")
+        write(*pending)
+        written += 1
+
+        fp.write(b';')
+
+    return written
+
+
+def write_webp(frames, output_path, lossless=False, quality=80, method=4, loop=0, workers=1):
+    """
+    Stream composited (frame, duration) pairs into an animated WebP file.
+
+    Frames go straight into libwebp's animation encoder (Pillow's own
+    save_all wants every frame up front), which only keeps the compressed
+    frames around until the file is assembled. `workers` frames are converted
+    to RGB in parallel (see `map_frames`); the encoder itself is sequential.
+
+    The encoder is private to Pillow, so on Pillow versions it wasn't checked
+    against (see STREAMING_WEBP_PILLOW), or if it rejects its arguments, this
+    falls back to Pillow's save_all, which holds every frame in memory.
+
+    Returns:
+        Number of frames written.
+    """
+    if not WebPImagePlugin.SUPPORTED:
+        raise RuntimeError("Pillow was built without WebP support")
+
+    frames = map_frames(_to_rgb, frames, workers)
+    if int(PIL.__version__.split('.')[0]) not in STREAMING_WEBP_PILLOW:
+        return _save_webp(frames, output_path, lossless, quality, method, loop)
+
+    encoder = None
+    timestamp = 0
+    written = 0
+
+    for frame, duration in frames:
+        if encoder is None:
+            try:
+                # Same arguments (and defaults) as WebPImagePlugin._save_all
+                encoder = WebPImagePlugin._webp.WebPAnimEncoder(
+                    frame.size,
+                    0,  # background
+                    loop,
+                    False,  # minimize_size
+                    9 if lossless else 3,  # kmin (same defaults as Pillow / gif2webp)
+                    17 if lossless else 5,  # kmax
+                    False,  # allow_mixed
+                    False,  # verbose
+                )
+                encoder.add(frame.getim(), timestamp, lossless, quality, 100, method)
+            except (AttributeError, TypeError):
+                # The private API changed under us
+                return _save_webp(
+                    itertools.chain([(frame, duration)], frames), output_path, lossless, quality, method, loop
+                )
+        else:
+            encoder.add(frame.getim(), timestamp, lossless, quality, 100, method)
+        timestamp += duration
+        written += 1
+
+    if encoder is None:
+        raise ValueError("No frames to write")
+
+    # Flush the last frame and put the file together
+    encoder.add(None, timestamp, lossless, quality, 100, 0)
+    data = encoder.assemble(b'', b'', b'')
+    if data is None:
+        raise OSError("cannot write file as WebP (encoder returned None)")
+
+    with open(output_path, 'wb') as fp:
+        fp.write(data)
+
+    return written
+
+
+def _save_webp(frames, output_path, lossless, quality, method, loop):
+    """Animated WebP through Pillow's public writer, which needs every frame up front."""
+    images, durations = [], []
+    for frame, duration in frames:
+        images.append(frame)
+        durations.append(duration)
+    if not images:
+        raise ValueError("No frames to write")
+
+    images[0].save(
+        output_path, 'WEBP', save_all=True, append_images=images[1:], duration=durations, loop=loop,
+        lossless=lossless, quality=quality, method=method,
+    )
+    return len(images)
+
+
+def encode(frames, output_path, output_format, colors, gifsicle_lossy, workers=1):
+    """
+    Encode composited (frame, duration) pairs in the given formats.OutputFormat.
+
+    GIF goes through palette quantization, the GIF writer and gifsicle
+    (`colors` and `gifsicle_lossy` only apply there); WebP is encoded straight
+    from the composited frames. `workers` is passed on to the per-frame
+    stages (see `map_frames`).
+
+    Returns:
+        Number of frames written.
+    """
+    if output_format.ext == 'webp':
+        return write_webp(
+            frames, output_path, lossless=output_format.lossless, quality=output_format.quality, workers=workers
+        )
+
+    written = write_gif(quantize_frames(frames, colors, workers=workers), output_path)
+    optimize_gif(output_path, gifsicle_lossy, colors)
+    return written
+
+
+def optimize_gif(output_path, gifsicle_lossy, colors):
+    """gifsicle post-processing for frame differencing and lossy compression."""
+    if gifsicle_lossy is not None and shutil.which('gifsicle'):
+        try:
+            subprocess.run(
+                [
+                    'gifsicle',
+                    '--optimize=3',
+                    f'--lossy={gifsicle_lossy}',
+                    '--colors', str(colors),
+                    str(output_path),
+                    '-o', str(output_path),
+                ],
+                check=True,
+                capture_output=True,
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"gifsicle optimization failed (non-fatal): {e.stderr.decode()}")
+    elif gifsicle_lossy is not None:
+        print("gifsicle not found on PATH — skipping post-processing optimization")
@@ -0,0 +1,204 @@
+"""
+Deadline-aware render quality.
+
+Every render has a deadline: RENDER_DEADLINE seconds after the interaction
+was created, since users give up long before Discord's interaction token
+expires. Render times are remembered per template tier, output format and
+quality level, and before rendering `plan` picks the first level on the
+degradation ladder (see LADDER) that is predicted to finish in time:
+
+    full -> fewer colors -> lower tier -> every other frame -> no blur -> no gifsicle
+
+Each level includes everything before it. Degraded renders are cached under
+their own entries (see cache.entry_path) and re-rendered at full quality in
+the background once the renderer is idle (`upgrade_later`).
+"""
+
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import time
+import uuid
+
+from src import cache, dispatch, files, tiers
+
+
+RENDER_DEADLINE = float(os.getenv('RENDER_DEADLINE', '20'))
+# Assumed render time of a template nothing is known about yet
+DEFAULT_RENDER_SECONDS = float(os.getenv('DEFAULT_RENDER_SECONDS', '6'))
+# How often a pending upgrade checks whether the renderer is idle
+UPGRADE_IDLE_POLL = float(os.getenv('UPGRADE_IDLE_POLL', '5'))
+
+
+@dataclass(frozen=True)
+class Quality:
+    """
+    One step of the degradation ladder.
+
+    Attributes:
+        name: For logs
+        colors: Palette size cap (GIF only), None for the renderer's default
+        tier_drop: Template tiers to go down from the planned one
+        frame_step: Keep every n-th frame (durations of dropped frames are folded into kept ones)
+        blur: Blur the avatars
+        gifsicle: Run gifsicle on GIFs
+        cost: Expected render time relative to full quality at the same tier, used without history
+    """
+    name: str
+    colors: int = None
+    tier_drop: int = 0
+    frame_step: int = 1
+    blur: bool = True
+    gifsicle: bool = True
+    cost: float = 1.0
+
+    def render_kwargs(self):
+        """Keyword arguments for the renderers' quality knobs."""
+        kwargs = {'frame_step': self.frame_step}
+        if self.colors is not None:
+            kwargs['colors'] = self.colors
+        if not self.blur:
+            kwargs['blur_radius'] = 0
+        if not self.gifsicle:
+            kwargs['gifsicle_lossy'] = None
+        return kwargs
+
+
+LADDER = (
+    Quality('full'),
+    Quality('fewer colors', colors=32, cost=0.9),
+    Quality('lower tier', colors=32, tier_drop=1, cost=0.9),
+    Quality('half frames', colors=32, tier_drop=1, frame_step=2, cost=0.5),
+    Quality('no blur', colors=32, tier_drop=1, frame_step=2, blur=False, cost=0.45),
+    Quality('no gifsicle', colors=32, tier_drop=1, frame_step=2, blur=False, gifsicle=False, cost=0.25),
+)
+LEVELS = range(len(LADDER))
+
+# (template name, tier, output format name, level) -> recent render time in seconds
+render_seconds = {}
+# full quality cache file -> pending upgrade task
+_upgrades = {}
+# Full quality cache files whose render didn't fit the upload limit, most recent last;
+# retrying them would only redo the same render every time the degraded entry is hit
+_failed_upgrades = OrderedDict()
+FAILED_UPGRADES_SIZE = 1024
+
+
+def deadline(interaction):
+    """Wall clock time (time.time()) a render for this interaction should be done by."""
+    created_at = getattr(interaction, 'created_at', None)
+    start = created_at.timestamp() if created_at is not None else time.time()
+    return start + RENDER_DEADLINE
+
+
+def record_cost(template_path, tier, output_format, level, seconds):
+    """
+    Remember how long a render took (smoothed).
+
+    `seconds` is the render's own run time on an idle renderer (see
+    dispatch.run_timed_render), not counting waiting for admission or time
+    lost to other renders, which `plan` accounts for separately.
+    """
+    key = (Path(template_path).stem, tier, output_format, level)
+    previous = render_seconds.get(key)
+    render_seconds[key] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+
+
+def predicted_cost(template_path, tier, output_format, level):
+    """
+    Expected render time (seconds) on an otherwise idle renderer.
+
+    Without history for this exact combination, it's extrapolated from
+    another level or tier of the same template (render time scales with the
+    pixel count and the level's relative cost).
+    """
+    name = Path(template_path).stem
+    key = (name, tier, output_format, level)
+    if key in render_seconds:
+        return render_seconds[key]
+
+    for (known_name, known_tier, known_format, known_level), seconds in render_seconds.items():
+        if known_name == name and known_format == output_format:
+            return seconds * (tier / known_tier) ** 2 * LADDER[level].cost / LADDER[known_level].cost
+    return DEFAULT_RENDER_SECONDS * (tier / 100) ** 2 * LADDER[level].cost
+
+
+def _tier_for(tier, level):
+    for _ in range(LADDER[level].tier_drop):
+        tier = tiers.lower_tier(tier) or tier
+    return tier
+
+
+def plan(template_path, tier, output_format, deadline_at, load=0):
+    """
+    Pick the best quality expected to finish before the deadline.
+
+    Renders running at the same time share the CPUs, so predictions are
+    stretched by how oversubscribed they are once this render joins.
+
+    Args:
+        template_path: Full resolution template
+        tier: Tier picked for the upload limit and load (see tiers.select_tier)
+        output_format: Output format name
+        deadline_at: See `deadline`
+        load: Renders currently running or waiting
+
+    Returns:
+        (tier, level), level being an index into LADDER
+    """
+    remaining = deadline_at - time.time()
+    contention = max(1.0, (load + 1) / dispatch.CPU_COUNT)
+    for level in LEVELS:
+        level_tier = _tier_for(tier, level)
+        if predicted_cost(template_path, level_tier, output_format, level) * contention <= remaining:
+            return level_tier, level
+    return _tier_for(tier, LEVELS[-1]), LEVELS[-1]
+
+
+def upgrade_later(cache_file, degraded_file, render, logger=None):
+    """
+    Replace a degraded cache entry with a full quality render, in the background.
+
+    The upgrade waits until no other render is running or queued, so it only
+    uses otherwise idle capacity. Upgrades that came out too large aren't
+    tried again.
+
+    Args:
+        cache_file: Full quality cache entry to produce
+        degraded_file: Degraded entry to remove once it's there
+        render: async callable(output_path) rendering at full quality, returning
+            whether the result is usable (e.g. fits the upload limit)
+    """
+    if cache_file in _upgrades or cache_file in _failed_upgrades:
+        return
+    task = asyncio.create_task(_upgrade(cache_file, degraded_file, render, logger))
+    _upgrades[cache_file] = task
+    task.add_done_callback(lambda _: _upgrades.pop(cache_file, None))
+
+
+async def _upgrade(cache_file, degraded_file, render, logger):
+    while dispatch.running + dispatch.queued() > 0:
+        await asyncio.sleep(UPGRADE_IDLE_POLL)
+
+    temp_output = f'temp/upgrade_{uuid.uuid4().hex}{Path(cache_file).suffix}'
+    try:
+        async with cache.render_lock(cache_file, logger):
+            if not await files.exists(cache_file):
+                if not await render(temp_output):
+                    _failed_upgrades[cache_file] = True
+                    while len(_failed_upgrades) > FAILED_UPGRADES_SIZE:
+                        _failed_upgrades.popitem(last=False)
+                    if logger is not None:
+                        logger.info(f"Full quality render for {degraded_file} doesn't fit, keeping it")
+                    return
+                await asyncio.to_thread(cache.publish, temp_output, cache_file)
+        await files.remove(degraded_file)
+        if logger is not None:
+            logger.info(f"Upgraded {degraded_file} to {cache_file}")
+    except Exception as e:
+        if logger is not None:
+            logger.error(f"Failed to upgrade {degraded_file}: {e}")
+    finally:
+        await files.remove(temp_output)
@@ -0,0 +1,230 @@
+"""
+Offline batch renderer.
+
+Renders avatar images through the same render functions the bot uses, in a
+process pool, straight into the live cache layout (cache/<kind>/...), and
+reports throughput. Useful for pre-warming the cache before an event,
+reproducing slow renders and as a load generator for the render engine.
+
+    python -m src.render boiler avatars/
+    python -m src.render framemog manifest.csv --format webp --jobs 8
+
+Avatars come from a directory of images or a CSV manifest:
+
+- directory: every image is one avatar. Files named `<user id>_<avatar key>.<ext>`
+  render into that user's cache entry, anything else gets user id 0 and a key
+  derived from the file's contents.
+- manifest: columns `image,user_id,avatar_key`, plus `caller_image,caller_id,caller_key`
+  for framemog (the caller mogs the avatar in `image`). Empty ids/keys are
+  filled in like for a directory.
+
+Framemog jobs without a caller are mogged by `--caller`, or else by the next
+avatar in the list.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+from dataclasses import dataclass
+import hashlib
+import os
+from pathlib import Path
+import re
+import time
+import uuid
+
+from PIL import Image
+
+from src import avatars, cache, formats, templates
+
+
+TEMPLATE_DIR = Path('templates')
+KINDS = ('boiler', 'framemog')
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+NAMED_AVATAR = re.compile(r'^(\d+)_(.+)$')
+
+
+@dataclass
+class Avatar:
+    """An avatar image standing in for a Discord user's display avatar."""
+    image: Path
+    user_id: int
+    key: str
+
+    @property
+    def animated(self):
+        """Same rule as avatars.wants_animated: a_-prefixed key and animations enabled."""
+        return avatars.ANIMATED_AVATARS and self.key.startswith('a_')
+
+
+@dataclass
+class Job:
+    kind: str
+    target: Avatar
+    caller: Avatar = None
+
+    def cache_key(self):
+        """Cache key exactly as the command handlers build it."""
+        if self.kind == 'boiler':
+            key = f'{self.target.user_id}_{self.target.key}'
+            return key + '_anim' if self.target.animated else key
+        key = f'{self.target.user_id}_{self.caller.user_id}_{self.target.key}_{self.caller.key}'
+        return key + '_anim' if self.target.animated or self.caller.animated else key
+
+
+def _content_key(image):
+    with open(image, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:32]
+
+
+def load_avatar(image, user_id=None, key=None):
+    """Avatar for an image file, taking missing ids/keys from its name or contents."""
+    image = Path(image)
+    match = NAMED_AVATAR.match(image.stem)
+    if user_id in (None, '') and key in (None, '') and match:
+        user_id, key = match.groups()
+    return Avatar(image, int(user_id or 0), key or _content_key(image))
+
+
+def read_avatars(source):
+    """(target, caller or None) pairs from a directory or manifest."""
+    source = Path(source)
+    if source.is_dir():
+        images = sorted(p for p in source.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+        return [(load_avatar(image), None) for image in images]
+
+    pairs = []
+    with open(source, newline='') as f:
+        for row in csv.DictReader(f):
+            base = source.parent
+            target = load_avatar(base / row['image'], row.get('user_id'), row.get('avatar_key'))
+            caller = None
+            if row.get('caller_image'):
+                caller = load_avatar(base / row['caller_image'], row.get('caller_id'), row.get('caller_key'))
+            pairs.append((target, caller))
+    return pairs
+
+
+def make_jobs(kind, pairs, caller=None):
+    if kind == 'boiler':
+        return [Job(kind, target) for target, _ in pairs]
+
+    jobs = []
+    for index, (target, pair_caller) in enumerate(pairs):
+        pair_caller = pair_caller or caller or pairs[(index + 1) % len(pairs)][0]
+        jobs.append(Job(kind, target, pair_caller))
+    return jobs
+
+
+def _open_avatar(avatar, size):
+    """Decode an avatar like the bot would receive it from the CDN at `size`."""
+    if avatar.animated:
+        return avatars.AnimatedAvatar(avatar.image.read_bytes())
+    image = Image.open(avatar.image).convert('RGBA')
+    if max(image.size) > size:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    return image
+
+
+def render_job(job, template, tier, output_format, force=False):
+    """
+    Render one job into the cache (runs in a worker process).
+
+    Returns:
+        (cache file, output bytes, seconds), with 0 bytes if the entry already existed.
+    """
+    from src.commands.boiler import replace_green_square_in_gif
+    from src.commands.framemog import replace_color_squares_in_gif
+
+    fmt = formats.get_format(output_format)
+    cache_file = cache.entry_path(job.kind, job.cache_key(), tier, fmt)
+    start = time.perf_counter()
+
+    lock = cache.RenderLock(cache_file)
+    lock.acquire()
+    try:
+        if not force and os.path.exists(cache_file):
+            return cache_file, 0, time.perf_counter() - start
+
+        _, info = templates.load_tier(template, tier)
+        temp_output = f'temp/render_{uuid.uuid4().hex}.{fmt.ext}'
+        try:
+            if job.kind == 'boiler':
+                size = avatars.request_size(info.max_slot_size('green'))
+                replace_green_square_in_gif(
+                    template, _open_avatar(job.target, size), temp_output, tier=tier, output_format=fmt.name,
+                )
+            else:
+                size = avatars.request_size(info.max_slot_size('green', 'purple'))
+                replace_color_squares_in_gif(
+                    template, _open_avatar(job.caller, size), _open_avatar(job.target, size), temp_output,
+                    tier=tier, output_format=fmt.name,
+                )
+            cache.publish(temp_output, cache_file)
+            return cache_file, os.path.getsize(temp_output), time.perf_counter() - start
+        finally:
+            if os.path.exists(temp_output):
+                os.remove(temp_output)
+    finally:
+        lock.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.render', description=__doc__.split('\n\n')[0])
+    parser.add_argument('kind', choices=KINDS, help="Which command's render to run")
+    parser.add_argument('source', help='Directory of avatar images or CSV manifest')
+    parser.add_argument('--template', help='Template GIF (default: templates/<kind>_template.gif)')
+    parser.add_argument('--tier', type=int, choices=templates.TIERS, default=100)
+    parser.add_argument('--format', dest='output_format', choices=list(formats.FORMATS), default=formats.DEFAULT_FORMAT)
+    parser.add_argument('--caller', help='Avatar image that mogs every framemog target without a caller')
+    parser.add_argument('--jobs', type=int, default=os.process_cpu_count(), help='Worker processes')
+    parser.add_argument('--repeat', type=int, default=1, help='Render the whole list this many times')
+    parser.add_argument('--force', action='store_true', help='Re-render entries that are already cached')
+    args = parser.parse_args(argv)
+
+    template = Path(args.template or TEMPLATE_DIR / f'{args.kind}_template.gif')
+    caller = load_avatar(args.caller) if args.caller else None
+    jobs = make_jobs(args.kind, read_avatars(args.source), caller) * args.repeat
+    if not jobs:
+        parser.error(f"No avatars found in {args.source}")
+
+    os.makedirs('temp', exist_ok=True)
+    # Compile the tier once up front instead of racing in every worker
+    templates.compile_tier(template, args.tier)
+
+    print(f"Rendering {len(jobs)} {args.kind} jobs at {args.tier}% as {args.output_format} with {args.jobs} workers")
+    rendered = skipped = failed = 0
+    total_bytes = 0
+    slowest = (0, None)
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {
+            pool.submit(render_job, job, template, args.tier, args.output_format, args.force or args.repeat > 1): job
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                cache_file, size, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"  failed: {futures[future].target.image}: {e}")
+                continue
+            if size == 0:
+                skipped += 1
+                continue
+            rendered += 1
+            total_bytes += size
+            slowest = max(slowest, (seconds, cache_file), key=lambda s: s[0])
+            print(f"  {cache_file}: {size / (1024 * 1024):.2f} MB in {seconds:.2f}s")
+
+    elapsed = time.perf_counter() - start
+    print(f"\n{rendered} rendered, {skipped} already cached, {failed} failed in {elapsed:.2f}s")
+    if rendered:
+        print(f"Throughput: {rendered / elapsed:.2f} renders/s, {total_bytes / (1024 * 1024) / elapsed:.2f} MB/s")
+        print(f"Slowest: {slowest[1]} ({slowest[0]:.2f}s)")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,270 @@
+"""
+Pre-scaled avatar sprites.
+
+Pasting an avatar into a template means resizing (and blurring) it to every
+slot size the template uses. Those sprites only depend on the avatar and the
+template tier, not on who else is in the picture, so they are cached per
+avatar key (Discord's avatar hash) and template tier:
+
+- in memory, in a small LRU
+- on disk under SPRITE_DIR as a compressed .npz per avatar and template tier,
+  shared between replicas and kept across restarts. The decoded avatar is
+  stored next to the sprites, so sizes or blur radii that weren't cached
+  (e.g. unblurred sprites for degraded renders, see quality.LADDER) can
+  still be scaled without downloading it again
+
+A `/framemog` of a pair that was never rendered before then only has to
+composite and encode when both avatars were seen before (in any pair): no
+download, no decode and no resampling. Only static avatars get sprites;
+animated ones still go through `avatars.AnimatedAvatar`.
+"""
+
+import asyncio
+from collections import OrderedDict
+import contextlib
+import itertools
+import os
+from pathlib import Path
+import threading
+import uuid
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from src import avatars, pipeline
+
+
+SPRITE_DIR = Path(os.getenv('SPRITE_DIR', 'cache/sprites'))
+SPRITE_CACHE_SIZE = int(os.getenv('SPRITE_CACHE_SIZE', '128'))
+# Oldest sprite files are removed once the directory grows past this
+SPRITE_DISK_LIMIT_MB = float(os.getenv('SPRITE_DISK_LIMIT_MB', '256'))
+# ... down to this fraction of the limit
+PRUNE_TO = 0.9
+
+# (avatar key, template tier name) -> SpriteSet, most recently used last
+_sprite_sets = OrderedDict()
+# load/store run in worker threads, and sets in the LRU are shared by concurrent renders
+_lock = threading.Lock()
+# Size of SPRITE_DIR as of the last prune plus what was written since, None before the first prune
+_disk_bytes = None
+
+
+class SpriteSet:
+    """
+    Scaled copies of one static avatar, keyed by (size, blur radius).
+
+    Missing sizes are scaled from the avatar on demand; sets built from
+    sprites alone (no `image`) only have what they were given.
+    """
+
+    def __init__(self, image=None, sprites=None):
+        self.image = image
+        self.sprites = sprites or {}
+        # Whether this set has sprites the cache doesn't have yet
+        self.dirty = False
+
+    @property
+    def size(self):
+        if self.image is not None:
+            return self.image.size
+        return max((size for size, _ in self.sprites), default=(0, 0))
+
+    def sprite(self, size, blur_radius):
+        key = (tuple(size), blur_radius)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            if self.image is None:
+                raise KeyError(f"No {size[0]}x{size[1]} sprite cached and no avatar to scale it from")
+            sprite = pipeline.scale_sprite(self.image, key[0], blur_radius)
+            with _lock:
+                self.sprites[key] = sprite
+                self.dirty = True
+        return sprite
+
+    def fill(self, sizes, blur_radius):
+        """Scale every size in `sizes` that isn't there yet."""
+        for size in sizes:
+            self.sprite(size, blur_radius)
+
+
+def slot_sizes(template_info):
+    """Every distinct slot size a template uses, over all its slots."""
+    return {box[1] for boxes in template_info.slots.values() for box in boxes if box is not None}
+
+
+def insert_sprites(image, template_info, blur_radius):
+    """
+    Per-template-frame SpriteSets for an insert image.
+
+    Static images (paths, PIL images, SpriteSets) get a single set holding
+    every slot size of the template, scaled up front. Animated avatars get
+    one set per distinct sampled frame, scaled as frames come up.
+    """
+    if isinstance(image, avatars.AnimatedAvatar):
+        sets = {}
+        for frame in image.sample(template_info.durations):
+            if id(frame) not in sets:
+                sets[id(frame)] = SpriteSet(frame)
+            yield sets[id(frame)]
+        return
+
+    if not isinstance(image, SpriteSet):
+        image = SpriteSet(avatars.as_rgba(image))
+    image.fill(slot_sizes(template_info), blur_radius)
+    yield from itertools.repeat(image)
+
+
+def _path(avatar_key, template_path):
+    return SPRITE_DIR / Path(template_path).stem / f'{avatar_key}.npz'
+
+
+def _read(path):
+    with np.load(path) as data:
+        image = None
+        sprites = {}
+        for name in data.files:
+            if name == 'source':
+                image = Image.fromarray(data[name], 'RGBA')
+                continue
+            size, blur_radius = name.split('_')
+            width, height = map(int, size.split('x'))
+            sprites[((width, height), float(blur_radius))] = Image.fromarray(data[name], 'RGBA')
+    return SpriteSet(image, sprites)
+
+
+def _write(path, image, sprites):
+    """Write a sprite file, returns its size."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    arrays = {
+        f'{w}x{h}_{blur_radius}': np.asarray(sprite)
+        for ((w, h), blur_radius), sprite in sprites.items()
+    }
+    if image is not None:
+        arrays['source'] = np.asarray(avatars.as_rgba(image))
+    temp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+            size = f.tell()
+        os.replace(temp_path, path)
+        return size
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def _prune_disk():
+    global _disk_bytes
+
+    files = []
+    for path in SPRITE_DIR.glob('*/*.npz'):
+        with contextlib.suppress(OSError):
+            stat = path.stat()
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    if total <= SPRITE_DISK_LIMIT_MB * 1024 * 1024:
+        target = total
+    else:
+        # Make some room, so the next few stores don't have to scan again
+        target = SPRITE_DISK_LIMIT_MB * 1024 * 1024 * PRUNE_TO
+    for _, size, path in sorted(files):
+        if total <= target:
+            break
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        total -= size
+    with _lock:
+        _disk_bytes = total
+
+
+def _remember(key, sprite_set):
+    with _lock:
+        _sprite_sets[key] = sprite_set
+        _sprite_sets.move_to_end(key)
+        while len(_sprite_sets) > SPRITE_CACHE_SIZE:
+            _sprite_sets.popitem(last=False)
+
+
+def load(avatar_key, template_path):
+    """Cached SpriteSet of an avatar for a template tier, or None. Blocking (may read disk)."""
+    key = (avatar_key, Path(template_path).stem)
+    with _lock:
+        if key in _sprite_sets:
+            _sprite_sets.move_to_end(key)
+            return _sprite_sets[key]
+
+    path = _path(avatar_key, template_path)
+    try:
+        sprite_set = _read(path)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+    # Written without the avatar, so it couldn't scale sizes or blur radii it doesn't have
+    if sprite_set.image is None:
+        return None
+    # Keep recently used files around when pruning
+    with contextlib.suppress(OSError):
+        os.utime(path)
+
+    _remember(key, sprite_set)
+    return sprite_set
+
+
+def store(avatar_key, template_path, sprite_set, logger=None):
+    """
+    Cache a SpriteSet after a render (no-op for anything else or if nothing's new). Blocking.
+
+    The cache is only an optimization, so failing to write it is logged, never raised.
+    """
+    global _disk_bytes
+
+    if not isinstance(sprite_set, SpriteSet):
+        return
+    with _lock:
+        if not sprite_set.dirty:
+            return
+        # Other renders sharing the set may add sprites while it's written
+        sprites = dict(sprite_set.sprites)
+        sprite_set.dirty = False
+    _remember((avatar_key, Path(template_path).stem), sprite_set)
+
+    try:
+        size = _write(_path(avatar_key, template_path), sprite_set.image, sprites)
+        # Only scan the directory once it may have grown past the limit
+        with _lock:
+            if _disk_bytes is not None:
+                _disk_bytes += size
+            prune = _disk_bytes is None or _disk_bytes > SPRITE_DISK_LIMIT_MB * 1024 * 1024
+        if prune:
+            _prune_disk()
+    except Exception as e:
+        sprite_set.dirty = True
+        if logger is not None:
+            logger.warning(f"Failed to cache avatar sprites: {e!r}")
+
+
+async def fetch_sprite_set(asset, template_path, size, logger=None, animated=False):
+    """
+    An avatar ready to render into a template tier.
+
+    Returns:
+        A SpriteSet from the sprite cache if this avatar was rendered into the
+        tier before, otherwise the avatar is fetched (see avatars.fetch_avatar)
+        and returned as a new SpriteSet, or as an AnimatedAvatar.
+    """
+    if not (animated and asset.is_animated()):
+        cached = await asyncio.to_thread(load, asset.key, template_path)
+        if cached is not None:
+            return cached
+
+    avatar = await avatars.fetch_avatar(asset, size, logger, animated)
+    if isinstance(avatar, avatars.AnimatedAvatar):
+        return avatar
+    return SpriteSet(avatar)
+
+
+async def fetch_sprite_sets(assets, template_path, size, logger=None, animated=False):
+    """Several `fetch_sprite_set`s concurrently, in the same order."""
+    return await asyncio.gather(*(fetch_sprite_set(asset, template_path, size, logger, animated) for asset in assets))
@@ -0,0 +1,343 @@
+"""
+Template metadata and compiled template tiers.
+
+Templates mark where avatars go with solid colored squares ("slots"):
+green (#00ff00) and purple (#ff00ff). Scanning a template for its slots is
+fairly expensive, so it's done once per template file and kept in memory.
+
+Templates are also compiled into lower resolution tiers (see TIERS). A tier
+is a downscaled copy of the template GIF plus a JSON sidecar with the slot
+track rescaled from the full resolution scan, since the slot colors don't
+survive downscaling cleanly enough to be detected again.
+
+The scan also works out a frame plan: runs of consecutive frames that look
+the same outside the slots, with the slots in the same place, are grouped so
+a render with static avatars composites and encodes each run once, shown for
+the run's combined duration (see TemplateInfo.merged). Frames count as the
+same if their backgrounds hash the same or, with TEMPLATE_DEDUP_THRESHOLD
+set, differ by less than that on average (per channel, 0-255). Changing the
+threshold needs the tiers recompiled (delete COMPILED_DIR).
+
+    python -m src.templates [template.gif ...]
+
+compiles every tier up front (of the boiler and framemog templates unless
+given others); otherwise tiers are compiled on first use.
+"""
+
+from dataclasses import asdict, dataclass, field, replace
+import functools
+import hashlib
+import json
+import math
+import os
+from pathlib import Path
+import sys
+import uuid
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from src import pipeline
+
+
+# Template scales in percent, highest first. 100 is the template itself.
+TIERS = (100, 75, 50)
+COMPILED_DIR = Path(os.getenv('COMPILED_TEMPLATE_DIR', 'cache/templates'))
+# Bumped whenever compiled tiers change, so older ones get recompiled
+TIER_VERSION = 2
+# Frames sampled to build a tier's palette
+PALETTE_SAMPLES = 8
+# Templates the renderers use tiers of (the petter doesn't)
+TIERED_TEMPLATES = ('boiler_template.gif', 'framemog_template.gif')
+# Mean per-channel difference outside the slots below which consecutive frames
+# are merged; 0 only merges exact duplicates
+DEDUP_THRESHOLD = float(os.getenv('TEMPLATE_DEDUP_THRESHOLD', '0'))
+
+
+def make_green_mask(arr):
+    """Detect #00ff00 green pixels."""
+    return (
+        (arr[:, :, 1] > 200) &
+        (arr[:, :, 0] < 100) &
+        (arr[:, :, 2] < 100)
+    )
+
+
+def make_purple_mask(arr):
+    """Detect #ff00ff purple/magenta pixels."""
+    return (
+        (arr[:, :, 0] > 200) &
+        (arr[:, :, 1] < 100) &
+        (arr[:, :, 2] > 200)
+    )
+
+
+SLOT_MASKS = {
+    'green': make_green_mask,
+    'purple': make_purple_mask,
+}
+
+
+def find_bounding_box(mask):
+    """Find bounding box of a boolean mask. Returns (pos, size) or None."""
+    rows = np.any(mask, axis=1)
+    cols = np.any(mask, axis=0)
+    if not rows.any() or not cols.any():
+        return None
+    y_min, y_max = np.where(rows)[0][[0, -1]]
+    x_min, x_max = np.where(cols)[0][[0, -1]]
+    pos = (int(x_min), int(y_min))
+    size = (int(x_max - x_min + 1), int(y_max - y_min + 1))
+    return pos, size
+
+
+@dataclass
+class TemplateInfo:
+    """
+    Slot geometry of a template.
+
+    Attributes:
+        path: Template file
+        size: Canvas (width, height)
+        durations: Per-frame durations in ms
+        slots: Slot color -> per-frame list of (pos, size) boxes, None where the slot isn't visible
+        frame_plan: (first frame, frame count) per run of duplicate frames, None if unknown
+    """
+    path: Path
+    size: tuple
+    durations: list = field(default_factory=list)
+    slots: dict = field(default_factory=dict)
+    frame_plan: list = None
+
+    @property
+    def frame_count(self):
+        return len(self.durations)
+
+    def max_slot_size(self, *colors):
+        """Largest width or height any of the given slots (all slots if none given) reaches."""
+        largest = 0
+        for color in colors or self.slots:
+            for box in self.slots.get(color, []):
+                if box is not None:
+                    largest = max(largest, *box[1])
+        return largest
+
+    def merged(self):
+        """
+        This slot track with each run of duplicate frames merged into its first frame.
+
+        Only valid for inserts that don't change from frame to frame (static
+        avatars); render it with the template frames from
+        `pipeline.decode_frames(path, frame_plan)`.
+        """
+        if self.frame_plan is None:
+            return self
+        return replace(
+            self,
+            durations=[sum(self.durations[first:first + count]) for first, count in self.frame_plan],
+            slots={color: [boxes[first] for first, _ in self.frame_plan] for color, boxes in self.slots.items()},
+            frame_plan=None,
+        )
+
+
+def _scale_box(box, scale, canvas):
+    """Scale a (pos, size) box, rounding outwards so it still covers the whole slot."""
+    if box is None:
+        return None
+    (x, y), (w, h) = box
+    left, top = math.floor(x * scale), math.floor(y * scale)
+    right = min(math.ceil((x + w) * scale), canvas[0])
+    bottom = min(math.ceil((y + h) * scale), canvas[1])
+    return (left, top), (max(right - left, 1), max(bottom - top, 1))
+
+
+def scale_info(info, scale, path):
+    """Slot track of `info` rescaled by `scale` (a fraction) for the template at `path`."""
+    size = (max(round(info.size[0] * scale), 1), max(round(info.size[1] * scale), 1))
+    return TemplateInfo(
+        path=Path(path),
+        size=size,
+        durations=list(info.durations),
+        slots={color: [_scale_box(box, scale, size) for box in boxes] for color, boxes in info.slots.items()},
+        frame_plan=info.frame_plan,
+    )
+
+
+def _sidecar(template_path):
+    return Path(template_path).with_suffix('.json')
+
+
+def _read_sidecar(template_path):
+    with open(_sidecar(template_path)) as f:
+        data = json.load(f)
+    return TemplateInfo(
+        path=Path(template_path),
+        size=tuple(data['size']),
+        durations=data['durations'],
+        slots={
+            color: [None if box is None else (tuple(box[0]), tuple(box[1])) for box in boxes]
+            for color, boxes in data['slots'].items()
+        },
+        frame_plan=None if data.get('frame_plan') is None else [tuple(run) for run in data['frame_plan']],
+    )
+
+
+def _sidecar_current(sidecar, source_mtime):
+    """Whether a tier's sidecar is newer than its template and written by the current compiler."""
+    if not sidecar.exists() or sidecar.stat().st_mtime < source_mtime:
+        return False
+    with open(sidecar) as f:
+        return json.load(f).get('version') == TIER_VERSION
+
+
+def _background(frame_array, boxes):
+    """Copy of a frame with the slot boxes blanked out."""
+    background = frame_array.copy()
+    for box in boxes:
+        if box is not None:
+            (x, y), (w, h) = box
+            background[y:y + h, x:x + w] = 0
+    return background
+
+
+def scan_template(template_path, colors=tuple(SLOT_MASKS), dedup_threshold=DEDUP_THRESHOLD):
+    """Scan every frame of a template for its slot bounding boxes and frame plan."""
+    template = Image.open(template_path)
+    info = TemplateInfo(path=Path(template_path), size=template.size, slots={c: [] for c in colors}, frame_plan=[])
+
+    # Background and slot geometry of the first frame of the current run
+    run_background = run_boxes = run_hash = None
+    for frame in ImageSequence.Iterator(template):
+        frame_array = np.array(frame.convert('RGB'))
+        boxes = tuple(find_bounding_box(SLOT_MASKS[color](frame_array)) for color in colors)
+        for color, box in zip(colors, boxes):
+            info.slots[color].append(box)
+        info.durations.append(frame.info.get('duration', 100))
+
+        background = _background(frame_array, boxes)
+        background_hash = hashlib.blake2b(background.tobytes(), digest_size=16).digest()
+        duplicate = boxes == run_boxes and (
+            background_hash == run_hash or
+            (dedup_threshold > 0 and
+             np.abs(background.astype(np.int16) - run_background).mean() < dedup_threshold)
+        )
+        if duplicate:
+            first, count = info.frame_plan[-1]
+            info.frame_plan[-1] = (first, count + 1)
+        else:
+            info.frame_plan.append((len(info.durations) - 1, 1))
+            run_background, run_boxes, run_hash = background.astype(np.int16), boxes, background_hash
+
+    return info
+
+
+@functools.lru_cache(maxsize=16)
+def _load_template_info(template_path, mtime):
+    sidecar = _sidecar(template_path)
+    if sidecar.exists() and sidecar.stat().st_mtime >= mtime:
+        return _read_sidecar(template_path)
+    return scan_template(template_path)
+
+
+def load_template_info(template_path):
+    """
+    Cached slot track of a template; re-loads if the template file changes.
+
+    Compiled tiers come with their slot track in a JSON sidecar, everything
+    else is scanned.
+    """
+    return _load_template_info(str(template_path), os.path.getmtime(template_path))
+
+
+def tier_path(template_path, tier):
+    """Where the compiled `tier` (percent) of a template lives."""
+    if tier == 100:
+        return Path(template_path)
+    return COMPILED_DIR / f'{Path(template_path).stem}_{tier}.gif'
+
+
+def compile_tier(template_path, tier):
+    """
+    Compile one tier of a template (if it isn't already up to date).
+
+    Frames are downscaled with LANCZOS and mapped back to the template's own
+    colors (templates use few, boiler about 30). Re-quantizing each frame to
+    its own 256 color palette kept LANCZOS's in-between colors instead, so
+    renders from a tier had to quantize hundreds of colors down to theirs,
+    flickering pixels that don't move in the template, and came out about as
+    large as full resolution renders. Every source frame is kept (unchanged
+    frames become 1x1 updates) so the frames stay aligned with the rescaled
+    slot track. The frame plan is the full resolution one.
+
+    Returns:
+        Path of the compiled tier GIF.
+    """
+    output_path = tier_path(template_path, tier)
+    if tier == 100:
+        return output_path
+
+    sidecar = _sidecar(output_path)
+    if output_path.exists() and _sidecar_current(sidecar, os.path.getmtime(template_path)):
+        return output_path
+
+    info = scale_info(load_template_info(template_path), tier / 100, output_path)
+
+    def downscale(frames):
+        for frame, duration in frames:
+            yield frame.convert('RGB').resize(info.size, Image.Resampling.LANCZOS), duration
+
+    # The template's own colors, from evenly spaced full resolution frames
+    # stacked into one image
+    step = max(info.frame_count // PALETTE_SAMPLES, 1)
+    samples = [
+        frame.convert('RGB') for index, (frame, _) in enumerate(pipeline.decode_frames(template_path))
+        if index % step == 0
+    ]
+    width, height = samples[0].size
+    mosaic = Image.new('RGB', (width, height * len(samples)))
+    for index, frame in enumerate(samples):
+        mosaic.paste(frame, (0, height * index))
+    palette = mosaic.quantize(256, method=Image.Quantize.MEDIANCUT)
+
+    # Several workers may compile the same tier at once; each writes its own
+    # temp files and the renames decide who wins
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = output_path.with_name(f'.{output_path.name}.{uuid.uuid4().hex}.tmp')
+    pipeline.write_gif(
+        pipeline.quantize_frames(
+            downscale(pipeline.decode_frames(template_path)), 256, keep_unchanged=True, palette=palette
+        ),
+        temp_path,
+    )
+
+    data = asdict(info)
+    data['path'] = str(data['path'])
+    data['version'] = TIER_VERSION
+    temp_sidecar = sidecar.with_name(f'.{sidecar.name}.{uuid.uuid4().hex}.tmp')
+    with open(temp_sidecar, 'w') as f:
+        json.dump(data, f)
+
+    # Sidecar first, so anyone who sees the new GIF also finds its slot track
+    os.replace(temp_sidecar, sidecar)
+    os.replace(temp_path, output_path)
+
+    return output_path
+
+
+def load_tier(template_path, tier):
+    """Compile (if needed) and load a tier. Returns (tier GIF path, TemplateInfo)."""
+    path = compile_tier(template_path, tier)
+    return path, load_template_info(path)
+
+
+def compile_all(template_paths, tiers=TIERS):
+    for template_path in template_paths:
+        for tier in tiers:
+            compile_tier(template_path, tier)
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or [Path('templates') / name for name in TIERED_TEMPLATES]
+    for path in paths:
+        for tier in TIERS:
+            print(f"{path} @ {tier}% -> {compile_tier(path, tier)}")
@@ -0,0 +1,86 @@
+"""
+Per-request template tier selection.
+
+Picks the highest resolution tier (see templates.TIERS) that is expected to
+fit the destination's upload limit, then steps down further while the render
+queue is long. Output sizes of past renders are remembered per template tier
+and output format to predict what a render will weigh; tiers without history
+are extrapolated from the ones that have it, conservatively: output size
+doesn't shrink with pixel count (flat regions compress well at any size), so
+going down it's only assumed to shrink linearly with the tier scale, and
+going up to grow with its square.
+"""
+
+import os
+from pathlib import Path
+
+from src import templates
+
+
+# Discord's upload limit for servers without boosts (and DMs), when the interaction doesn't tell us
+DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024
+# Keep some margin below the upload limit
+UPLOAD_HEADROOM = 0.95
+# Drop one tier for every this many renders running or queued
+TIER_QUEUE_STEP = int(os.getenv('TIER_QUEUE_STEP', '4'))
+
+# (template name, output format name, tier) -> recent output size in bytes
+output_sizes = {}
+
+
+def upload_limit(interaction):
+    """Largest file we can send in reply to this interaction."""
+    return getattr(interaction, 'filesize_limit', None) or DEFAULT_UPLOAD_LIMIT
+
+
+def record_output_size(template_path, tier, size, output_format='gif'):
+    """Remember the size of a finished render (smoothed)."""
+    key = (Path(template_path).stem, output_format, tier)
+    previous = output_sizes.get(key)
+    output_sizes[key] = size if previous is None else int(0.7 * previous + 0.3 * size)
+
+
+def predicted_size(template_path, tier, output_format='gif'):
+    """Expected output size (bytes) of a render at `tier`, or None without any history."""
+    name = Path(template_path).stem
+    if (name, output_format, tier) in output_sizes:
+        return output_sizes[(name, output_format, tier)]
+    for known in templates.TIERS:
+        if (name, output_format, known) in output_sizes:
+            scale = tier / known
+            # Overestimate rather than pick a tier that doesn't fit and has to be rendered again
+            return int(output_sizes[(name, output_format, known)] * (scale if scale < 1 else scale ** 2))
+    return None
+
+
+def lower_tier(tier):
+    """Next tier down, or None at the bottom."""
+    lower = [t for t in templates.TIERS if t < tier]
+    return lower[0] if lower else None
+
+
+def select_tier(template_path, limit, load=0, output_format='gif'):
+    """
+    Pick a tier for a render.
+
+    Args:
+        template_path: Full resolution template
+        limit: Upload limit in bytes, see `upload_limit`
+        load: Renders currently running or waiting
+        output_format: Output format name
+
+    Returns:
+        Tier in percent (one of templates.TIERS)
+    """
+    candidates = list(templates.TIERS)
+
+    # Highest tier predicted to fit; if none does, the lowest one is our best shot
+    fitting = [
+        tier for tier in candidates
+        if (predicted_size(template_path, tier, output_format) or 0) <= limit * UPLOAD_HEADROOM
+    ]
+    index = candidates.index(fitting[0]) if fitting else len(candidates) - 1
+
+    # Under load, trade resolution for throughput
+    index += load // TIER_QUEUE_STEP
+    return candidates[min(index, len(candidates) - 1)]